@@ -5,6 +5,8 @@
 """
 
 import sys
+import stat
+import importlib.util
 from pathlib import Path
 from typing import List, Tuple
 from dotenv import load_dotenv
@@ -15,21 +17,58 @@ import os
 load_dotenv()
 
 
+class Config:
+    """Класс для хранения конфигурации из переменных окружения (читается один раз)"""
+    
+    # IMAP настройки
+    IMAP_SERVER: str = os.getenv('IMAP_SERVER', '')
+    IMAP_PORT: str = os.getenv('IMAP_PORT', '')
+    IMAP_LOGIN: str = os.getenv('IMAP_LOGIN', '')
+    IMAP_PASSWORD: str = os.getenv('IMAP_PASSWORD', '')
+    
+    # Настройки поиска письма
+    EMAIL_FROM: str = os.getenv('EMAIL_FROM', '')
+    ATTACHMENT_FILENAME: str = os.getenv('ATTACHMENT_FILENAME', '')
+    
+    # Пути
+    BASE_DIR: str = os.getenv('BASE_DIR', '')
+    DOWNLOAD_DIR: str = os.getenv('DOWNLOAD_DIR', '')
+    TARGET_DIR: str = os.getenv('TARGET_DIR', '')
+    BRANDS_DIR: str = os.getenv('BRANDS_DIR', '')
+
+
+# Строки отчета накапливаются и выводятся одной операцией записи в конце проверки
+_report_lines: List[str] = []
+
+
+def report(message: str = "") -> None:
+    """Добавляет строку в отчет о проверке"""
+    _report_lines.append(message)
+
+
+def flush_report() -> None:
+    """Выводит накопленный отчет одной операцией записи"""
+    if _report_lines:
+        sys.stdout.write("\n".join(_report_lines) + "\n")
+        sys.stdout.flush()
+        _report_lines.clear()
+
+
 def check_python_version() -> bool:
     """Проверяет версию Python"""
-    print("Проверка версии Python...")
+    report("Проверка версии Python...")
     version = sys.version_info
     if version.major >= 3 and version.minor >= 7:
-        print(f"  ✓ Python {version.major}.{version.minor}.{version.micro} - OK")
+        report(f"  ✓ Python {version.major}.{version.minor}.{version.micro} - OK")
         return True
     else:
-        print(f"  ✗ Python {version.major}.{version.minor}.{version.micro} - требуется Python 3.7+")
+        report(f"  ✗ Python {version.major}.{version.minor}.{version.micro} - требуется Python 3.7+")
         return False
 
 
 def check_standard_libraries() -> bool:
     """Проверяет стандартные библиотеки, используемые в download_price.py"""
-    print("\nПроверка стандартных библиотек...")
+    report("\nПроверка стандартных библиотек...")
     libraries = [
         'imaplib', 'email', 'ssl', 'os', 'pathlib', 
         'zipfile', 'csv', 're'
@@ -37,11 +76,11 @@ def check_standard_libraries() -> bool:
     
     all_ok = True
     for lib in libraries:
-        try:
-            __import__(lib)
-            print(f"  ✓ {lib} - OK")
-        except ImportError:
-            print(f"  ✗ {lib} - отсутствует")
+        # find_spec только ищет модуль, не выполняя его код
+        if importlib.util.find_spec(lib) is not None:
+            report(f"  ✓ {lib} - OK")
+        else:
+            report(f"  ✗ {lib} - отсутствует")
             all_ok = False
     
     return all_ok
@@ -49,7 +88,7 @@ def check_standard_libraries() -> bool:
 
 def check_third_party_libraries() -> bool:
     """Проверяет сторонние библиотеки"""
-    print("\nПроверка сторонних библиотек...")
+    report("\nПроверка сторонних библиотек...")
     libraries = ['dotenv']
     
     all_ok = True
@@ -57,9 +96,9 @@ def check_third_party_libraries() -> bool:
         try:
             if lib == 'dotenv':
                 __import__('dotenv')
-            print(f"  ✓ {lib} - OK")
+            report(f"  ✓ {lib} - OK")
         except ImportError:
-            print(f"  ✗ {lib} - отсутствует (установите: pip install python-dotenv)")
+            report(f"  ✗ {lib} - отсутствует (установите: pip install python-dotenv)")
             all_ok = False
     
     return all_ok
@@ -67,15 +106,15 @@ def check_third_party_libraries() -> bool:
 
 def check_env_file() -> bool:
     """Проверяет наличие и корректность .env файла"""
-    print("\nПроверка файла .env...")
+    report("\nПроверка файла .env...")
     
     env_file = Path(".env")
     if not env_file.exists():
-        print("  ✗ Файл .env не найден")
-        print("  → Создайте файл .env на основе .env.example")
+        report("  ✗ Файл .env не найден")
+        report("  → Создайте файл .env на основе .env.example")
         return False
     
-    print("  ✓ Файл .env найден")
+    report("  ✓ Файл .env найден")
     
     # Проверяем наличие обязательных переменных
     required_vars = [
@@ -90,21 +129,17 @@ def check_env_file() -> bool:
         'TARGET_DIR'
     ]
     
-    missing_vars: List[str] = []
-    for var in required_vars:
-        value = os.getenv(var)
-        if not value:
-            missing_vars.append(var)
+    missing_vars: List[str] = [var for var in required_vars if not getattr(Config, var)]
     
     if missing_vars:
-        print(f"  ✗ Отсутствуют обязательные переменные: {', '.join(missing_vars)}")
+        report(f"  ✗ Отсутствуют обязательные переменные: {', '.join(missing_vars)}")
         return False
     
-    print("  ✓ Все обязательные переменные установлены")
+    report("  ✓ Все обязательные переменные установлены")
     
     # Проверяем, что пароль не пустой
-    if os.getenv('IMAP_PASSWORD', '').strip() == '':
-        print("  ⚠ IMAP_PASSWORD пустой - проверьте настройки")
+    if Config.IMAP_PASSWORD.strip() == '':
+        report("  ⚠ IMAP_PASSWORD пустой - проверьте настройки")
         return False
     
     return True
@@ -112,34 +147,39 @@ def check_env_file() -> bool:
 
 def check_paths() -> bool:
     """Проверяет наличие необходимых путей"""
-    print("\nПроверка путей...")
+    report("\nПроверка путей...")
     
-    base_dir = Path(os.getenv('BASE_DIR', '/home/rinat/wildberries'))
-    download_dir = Path(os.getenv('DOWNLOAD_DIR', '/home/rinat/wildberries/tmp'))
-    target_dir = Path(os.getenv('TARGET_DIR', '/home/rinat/wildberries/price'))
+    base_dir = Path(Config.BASE_DIR or '/home/rinat/wildberries')
+    download_dir = Path(Config.DOWNLOAD_DIR or '/home/rinat/wildberries/tmp')
+    target_dir = Path(Config.TARGET_DIR or '/home/rinat/wildberries/price')
     
     paths: List[Tuple[Path, str]] = [
         (base_dir, "Базовая папка"),
         (download_dir, "Временная папка для архивов"),
         (target_dir, "Папка для прайс-файлов"),
     ]
+    if Config.BRANDS_DIR:
+        paths.append((Path(Config.BRANDS_DIR), "Папка для файлов брендов"))
     
     all_ok = True
     for path, description in paths:
-        if path.exists():
-            if path.is_dir():
-                print(f"  ✓ {path} - существует ({description})")
-            else:
-                print(f"  ✗ {path} - существует, но это не папка")
-                all_ok = False
-        else:
-            print(f"  ⚠ {path} - не существует (будет создана автоматически)")
+        # Один вызов stat() вместо двух (exists() + is_dir())
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            report(f"  ⚠ {path} - не существует (будет создана автоматически)")
             # Создаем папку
             try:
                 path.mkdir(parents=True, exist_ok=True)
-                print(f"    → Создана")
+                report(f"    → Создана")
             except Exception as e:
-                print(f"    ✗ Ошибка создания: {e}")
+                report(f"    ✗ Ошибка создания: {e}")
+                all_ok = False
+        else:
+            if stat.S_ISDIR(st.st_mode):
+                report(f"  ✓ {path} - существует ({description})")
+            else:
+                report(f"  ✗ {path} - существует, но это не папка")
                 all_ok = False
     
     return all_ok
@@ -147,41 +187,41 @@ def check_paths() -> bool:
 
 def check_project_file() -> bool:
     """Проверяет наличие файла проекта"""
-    print("\nПроверка файла проекта...")
+    report("\nПроверка файла проекта...")
     file = "download_price.py"
     if Path(file).exists():
-        print(f"  ✓ {file} - найден")
+        report(f"  ✓ {file} - найден")
         return True
     else:
-        print(f"  ✗ {file} - не найден")
+        report(f"  ✗ {file} - не найден")
         return False
 
 
 def check_imap_settings() -> bool:
     """Проверяет настройки IMAP из .env файла"""
-    print("\nПроверка настроек IMAP...")
+    report("\nПроверка настроек IMAP...")
     
-    imap_server = os.getenv('IMAP_SERVER', '')
-    imap_port = os.getenv('IMAP_PORT', '')
-    imap_login = os.getenv('IMAP_LOGIN', '')
-    imap_password = os.getenv('IMAP_PASSWORD', '')
+    imap_server = Config.IMAP_SERVER
+    imap_port = Config.IMAP_PORT
+    imap_login = Config.IMAP_LOGIN
+    imap_password = Config.IMAP_PASSWORD
     
     if not all([imap_server, imap_port, imap_login, imap_password]):
-        print("  ✗ Не все настройки IMAP установлены в .env")
+        report("  ✗ Не все настройки IMAP установлены в .env")
         return False
     
-    print(f"  ✓ IMAP сервер: {imap_server}:{imap_port}")
-    print(f"  ✓ IMAP логин: {imap_login}")
-    print("  ⚠ Убедитесь, что логин и пароль актуальны")
+    report(f"  ✓ IMAP сервер: {imap_server}:{imap_port}")
+    report(f"  ✓ IMAP логин: {imap_login}")
+    report("  ⚠ Убедитесь, что логин и пароль актуальны")
     
     return True
 
 
-def main() -> bool:
-    """Основная функция"""
-    print("=" * 60)
-    print("ПРОВЕРКА ГОТОВНОСТИ СИСТЕМЫ ДЛЯ download_price.py")
-    print("=" * 60)
+def run_checks() -> bool:
+    """Выполняет все проверки и формирует отчет"""
+    report("=" * 60)
+    report("ПРОВЕРКА ГОТОВНОСТИ СИСТЕМЫ ДЛЯ download_price.py")
+    report("=" * 60)
     
     results: List[Tuple[str, bool]] = []
     results.append(("Версия Python", check_python_version()))
@@ -192,30 +232,38 @@ def main() -> bool:
     results.append(("Настройки IMAP", check_imap_settings()))
     results.append(("Пути", check_paths()))
     
-    print("\n" + "=" * 60)
-    print("РЕЗУЛЬТАТЫ:")
+    report("\n" + "=" * 60)
+    report("РЕЗУЛЬТАТЫ:")
     all_ok = True
     for name, result in results:
         status = "✓ OK" if result else "✗ ОШИБКА"
-        print(f"  {name}: {status}")
+        report(f"  {name}: {status}")
         if not result:
             all_ok = False
     
-    print("=" * 60)
+    report("=" * 60)
     if all_ok:
-        print("\n✓ Система готова к работе!")
-        print("\nДля запуска выполните:")
-        print("  python3 download_price.py")
+        report("\n✓ Система готова к работе!")
+        report("\nДля запуска выполните:")
+        report("  python3 download_price.py")
     else:
-        print("\n✗ Обнаружены проблемы. Исправьте их перед использованием.")
-        print("\nРекомендации:")
-        print("  1. Убедитесь, что файл .env существует и содержит все необходимые переменные")
-        print("  2. Установите недостающие библиотеки: pip install -r requirements.txt")
-        print("  3. Проверьте права доступа к папкам")
+        report("\n✗ Обнаружены проблемы. Исправьте их перед использованием.")
+        report("\nРекомендации:")
+        report("  1. Убедитесь, что файл .env существует и содержит все необходимые переменные")
+        report("  2. Установите недостающие библиотеки: pip install -r requirements.txt")
+        report("  3. Проверьте права доступа к папкам")
     
     return all_ok
 
 
+def main() -> bool:
+    """Основная функция"""
+    try:
+        return run_checks()
+    finally:
+        flush_report()
+
+
 if __name__ == "__main__":
     success = main()
     sys.exit(0 if success else 1)
@@ -2,11 +2,35 @@
 Скрипт для обнуления остатков товаров на Wildberries
 """
 import os
-import requests
-import pandas as pd
+import re
+import json
+import hashlib
 import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from pathlib import Path
 from dotenv import load_dotenv
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set, TYPE_CHECKING
+
+# Тяжелые зависимости (requests, pandas, openpyxl) импортируются внутри функций,
+# чтобы импорт модуля и ранний выход (нет токена, нет файлов) не тратили на них время
+if TYPE_CHECKING:
+    import requests
+
+# orjson сериализует JSON заметно быстрее стандартного json; если он не установлен,
+# используем стандартную библиотеку
+try:
+    import orjson
+    
+    def dumps_json(data: Any) -> bytes:
+        """Сериализовать данные в JSON (bytes)"""
+        return orjson.dumps(data)
+except ImportError:
+    def dumps_json(data: Any) -> bytes:
+        """Сериализовать данные в JSON (bytes)"""
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -14,6 +38,52 @@ load_dotenv()
 # API базовый URL
 BASE_URL = "https://marketplace-api.wildberries.ru/api/v3"
 
+# Кэш списка складов: склады меняются редко, поэтому повторный запуск
+# в течение WAREHOUSES_CACHE_TTL секунд обходится без запроса к API
+WAREHOUSES_CACHE_DIR = Path.home() / ".cache" / "wb"
+WAREHOUSES_CACHE_TTL = 3600
+
+# Количество параллельных потоков для отправки батчей
+MAX_WORKERS = 8
+
+# Минимальный интервал между запросами к API (общий для всех потоков), секунды
+REQUEST_INTERVAL = 0.5
+
+_rate_lock = threading.Lock()
+_next_request_time = 0.0
+
+# Размер буфера чтения xlsx файлов, байты
+XLSX_READ_BUFFER_SIZE = 1 << 20
+
+# Значения колонки баркодов, которые являются заголовками, а не баркодами
+BARCODE_HEADER_TOKENS = frozenset({'баркод', 'barcode', 'баркод в системе', ''})
+
+# Баркоды, которые склад не принимает (ошибка 409 CargoWarehouseRestriction): {warehouse_id: {sku}}
+UNSUPPORTED_SKUS: Dict[int, Set[str]] = defaultdict(set)
+_unsupported_lock = threading.Lock()
+
+# Батч с ошибкой 409 такого размера и меньше отправляется по одному баркоду, а не делится пополам
+RESTRICTED_BISECT_MIN_BATCH = 4
+
+def wait_for_request_slot() -> None:
+    """
+    Ограничивает частоту запросов к API для всех потоков сразу
+    
+    Каждый вызов резервирует следующий свободный слот с шагом REQUEST_INTERVAL
+    и ждет его наступления, чтобы параллельная отправка не приводила к ошибкам 429.
+    """
+    global _next_request_time
+    
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_request_time)
+        _next_request_time = slot + REQUEST_INTERVAL
+    
+    delay = slot - now
+    if delay > 0:
+        time.sleep(delay)
+
+@lru_cache(maxsize=1)
 def get_api_token() -> str:
     """
     Получить API токен из .env файла
@@ -39,225 +109,396 @@ def get_api_token() -> str:
     
     return token
 
+@lru_cache(maxsize=1)
 def get_headers() -> Dict[str, str]:
-    """Получить заголовки для API запросов"""
+    """Получить заголовки для API запросов (вычисляются один раз за процесс)"""
     token = get_api_token()
     return {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
 
+@lru_cache(maxsize=1)
+def get_session() -> 'requests.Session':
+    """
+    Получить общую HTTP сессию для API запросов
+    
+    Сессия переиспользует TCP/TLS соединения (keep-alive) между запросами
+    и повторяет запросы при превышении лимита (429) и временных ошибках сервера
+    (502/503/504). Пауза перед повтором берется из заголовка Retry-After,
+    а если его нет - растет экспоненциально (backoff_factor).
+    
+    Returns:
+        requests.Session: Сессия с заголовками авторизации
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    session.headers.update(get_headers())
+    
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    
+    return session
+
+def get_warehouses_cache_path() -> Path:
+    """Путь к файлу кэша складов (свой для каждого API токена)"""
+    token_hash = hashlib.sha256(get_api_token().encode('utf-8')).hexdigest()[:16]
+    return WAREHOUSES_CACHE_DIR / f"warehouses_{token_hash}.json"
+
+def load_cached_warehouses(max_age: Optional[float] = WAREHOUSES_CACHE_TTL) -> Optional[List[Dict[str, Any]]]:
+    """
+    Прочитать список складов из кэша
+    
+    Args:
+        max_age: Максимальный возраст кэша в секундах (None - любой возраст)
+        
+    Returns:
+        Optional[List[Dict[str, Any]]]: Список складов или None, если кэша нет или он устарел
+    """
+    cache_path = get_warehouses_cache_path()
+    try:
+        if max_age is not None and time.time() - os.stat(cache_path).st_mtime >= max_age:
+            return None
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            warehouses = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    return warehouses if isinstance(warehouses, list) else None
+
+def save_cached_warehouses(warehouses: List[Dict[str, Any]]) -> None:
+    """Сохранить список складов в кэш (ошибки записи не критичны)"""
+    cache_path = get_warehouses_cache_path()
+    tmp_path = cache_path.with_suffix('.tmp')
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(dumps_json(warehouses))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Предупреждение: не удалось сохранить кэш складов: {e}")
+
 def get_warehouses() -> List[Dict[str, Any]]:
-    """Получить список складов продавца"""
+    """
+    Получить список складов продавца
+    
+    Свежий кэш (моложе WAREHOUSES_CACHE_TTL) используется без запроса к API.
+    Если API недоступен, используется устаревший кэш, если он есть.
+    """
+    import requests
+    
+    warehouses = load_cached_warehouses()
+    if warehouses is not None:
+        return warehouses
+    
     url = f"{BASE_URL}/warehouses"
-    headers = get_headers()
     
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    try:
+        response = get_session().get(url)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        stale = load_cached_warehouses(max_age=None)
+        if stale:
+            print("Предупреждение: API складов недоступен, используется сохраненный список складов")
+            return stale
+        raise
     
     warehouses = response.json()
+    save_cached_warehouses(warehouses)
     return warehouses
 
+def read_excel_column(file_path: Path, column: int) -> List[Any]:
+    """
+    Прочитать одну колонку первого листа xlsx файла в потоковом режиме
+    
+    Args:
+        file_path: Путь к xlsx файлу
+        column: Номер колонки (с 1, как в Excel)
+        
+    Returns:
+        List[Any]: Непустые значения колонки без строки заголовка
+            (пустой список, если в листе нет такой колонки)
+    """
+    import openpyxl
+    
+    # Открываем файл с большим буфером: zipfile читает сжатые данные листа
+    # небольшими порциями, и крупный буфер сокращает число системных вызовов read()
+    with open(file_path, 'rb', buffering=XLSX_READ_BUFFER_SIZE) as f:
+        wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            
+            # Размер листа из файла (тег dimension) бывает неверным, и в режиме
+            # read_only строки и колонки дальше него не читаются - определяем размер по данным
+            ws.reset_dimensions()
+            
+            rows = ws.iter_rows(min_row=2, min_col=column, max_col=column, values_only=True)
+            return [row[0] for row in rows if row and row[0] is not None]
+        finally:
+            wb.close()
+
 def read_products_data() -> Dict[str, List[str]]:
     """Прочитать данные о товарах из xlsx файлов"""
+    import pandas as pd
+    
     products = {
         'nmIDs': [],
         'barcodes': []
     }
     
     # Читаем файл с артикулами (nmID)
-    art_file = None
-    for file in os.listdir('.'):
-        if 'Артикулы' in file and file.endswith('.xlsx'):
-            art_file = file
-            break
+    art_file = next(Path('.').glob('*Артикулы*.xlsx'), None)
     
     if art_file:
-        df_art = pd.read_excel(art_file, header=0)
+        # Читаем nmID из колонки C - "Артикул продавца"
+        col_nmid = read_excel_column(art_file, 3)
         
-        # Читаем nmID из колонки C (индекс 2) - "Артикул продавца"
-        if len(df_art.columns) > 2:
-            col_nmid = df_art.columns[2]  # Колонка C
-            
-            # Пропускаем заголовки (первые строки могут содержать текст)
-            values = df_art[col_nmid].dropna()
-            # Фильтруем только числовые значения (nmID - это числа)
-            nm_ids = []
-            for val in values:
-                try:
-                    # Пробуем преобразовать в число
-                    nm_id = int(float(val))
-                    nm_ids.append(str(nm_id))
-                except (ValueError, TypeError):
-                    # Пропускаем нечисловые значения (заголовки)
-                    continue
+        if col_nmid:
+            # Оставляем только числовые значения (nmID - это числа),
+            # нечисловые значения (заголовки) превращаются в NaN и отбрасываются
+            nm_ids = pd.to_numeric(pd.Series(col_nmid, dtype=object), errors='coerce').dropna().astype('int64')
+            nm_ids = nm_ids.astype(str).tolist()
             products['nmIDs'] = nm_ids
         else:
-            print("Ошибка: файл с артикулами не содержит колонку C")
+            print("Ошибка: в файле с артикулами нет данных в колонке C")
     
     # Читаем файл с баркодами
-    barcode_file = None
-    for file in os.listdir('.'):
-        if 'Баркоды' in file and file.endswith('.xlsx'):
-            barcode_file = file
-            break
+    barcode_file = next(Path('.').glob('*Баркоды*.xlsx'), None)
     
     if barcode_file:
-        df_barcode = pd.read_excel(barcode_file, header=0)
+        # Читаем баркоды из колонки G
+        col_barcode = read_excel_column(barcode_file, 7)
         
-        # Читаем баркоды из колонки G (индекс 6)
-        if len(df_barcode.columns) > 6:
-            col_barcode = df_barcode.columns[6]  # Колонка G
-            
-            # Пропускаем заголовки
-            values = df_barcode[col_barcode].dropna()
-            # Фильтруем только строковые значения, которые выглядят как баркоды
-            barcodes = []
-            for val in values:
-                val_str = str(val).strip()
-                # Пропускаем заголовки (текстовые значения)
-                if val_str.lower() not in ['баркод', 'barcode', 'баркод в системе', ''] and len(val_str) > 5:
-                    barcodes.append(val_str)
+        if col_barcode:
+            # Фильтруем только строковые значения, которые выглядят как баркоды,
+            # пропуская заголовки (текстовые значения)
+            values = pd.Series(col_barcode, dtype=object).astype(str).str.strip()
+            is_header = values.str.lower().isin(BARCODE_HEADER_TOKENS)
+            barcodes = values[~is_header & (values.str.len() > 5)].tolist()
             products['barcodes'] = barcodes
         else:
-            print("Ошибка: файл с баркодами не содержит колонку G")
+            print("Ошибка: в файле с баркодами нет данных в колонке G")
     
     return products
 
-def clear_stocks_by_barcodes(warehouse_id: int, barcodes: List[str], max_retries: int = 3) -> bool:
+# Баркоды из этих символов можно вставлять в JSON без экранирования
+SAFE_SKU_PATTERN = re.compile(r'[0-9A-Za-z]+')
+
+def build_zero_stocks_body(barcodes: List[str]) -> bytes:
+    """
+    Сформировать тело запроса {"stocks": [{"sku": ..., "amount": 0}, ...]} в виде bytes
+    
+    Для обычных баркодов (цифры и латиница) JSON собирается напрямую из строк,
+    без создания промежуточных словарей и вызова сериализатора.
+    
+    Args:
+        barcodes: Список баркодов
+        
+    Returns:
+        bytes: JSON тело запроса
+    """
+    if not barcodes or not all(SAFE_SKU_PATTERN.fullmatch(barcode) for barcode in barcodes):
+        return dumps_json({"stocks": [{"sku": barcode, "amount": 0} for barcode in barcodes]})
+    
+    items = '","amount":0},{"sku":"'.join(barcodes)
+    return ('{"stocks":[{"sku":"' + items + '","amount":0}]}').encode('ascii')
+
+def get_cargo_restriction(response: 'requests.Response') -> Optional[List[Dict[str, Any]]]:
+    """
+    Проверить, является ли ответ 409 ошибкой CargoWarehouseRestriction
+    
+    Args:
+        response: Ответ API со статусом 409
+        
+    Returns:
+        Optional[List[Dict[str, Any]]]: Тело ошибки или None, если это другая ошибка
+    """
+    try:
+        error_data = response.json()
+        if isinstance(error_data, list) and len(error_data) > 0:
+            error_code = error_data[0].get('code', '')
+            if 'CargoWarehouseRestriction' in error_code:
+                return error_data
+    except (ValueError, KeyError, IndexError, AttributeError):
+        pass
+    return None
+
+def extract_restricted_skus(error_data: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Извлечь баркоды, отклоненные складом, из тела ошибки 409
+    
+    Args:
+        error_data: Тело ошибки CargoWarehouseRestriction
+        
+    Returns:
+        Set[str]: Баркоды из поля data (пустое множество, если API их не вернул)
+    """
+    skus: Set[str] = set()
+    for error in error_data:
+        data = error.get('data') if isinstance(error, dict) else None
+        if not isinstance(data, list):
+            continue
+        for item in data:
+            if isinstance(item, dict) and item.get('sku'):
+                skus.add(str(item['sku']))
+    return skus
+
+def clear_restricted_batch(warehouse_id: int, barcodes: List[str], error_data: List[Dict[str, Any]]) -> bool:
+    """
+    Обнулить батч, часть товаров которого не подходит для склада (ODC/LCL)
+    
+    Отклоненные баркоды запоминаются в UNSUPPORTED_SKUS и больше не отправляются
+    на этот склад. Если API не указал конкретные баркоды, батч делится пополам,
+    а части не больше RESTRICTED_BISECT_MIN_BATCH отправляются по одному баркоду.
+    При k отклоненных баркодах из N это O(k*log2(N)) запросов (около 2*log2(N)
+    при одном), в худшем случае, когда отклонены почти все, - около 1.5*N
+    запросов (N запросов по одному баркоду плюс деление пополам).
+    
+    Args:
+        warehouse_id: ID склада
+        barcodes: Список баркодов батча
+        error_data: Тело ошибки CargoWarehouseRestriction
+        
+    Returns:
+        bool: True - ODC товары пропускаются, это не считается ошибкой
+    """
+    restricted = extract_restricted_skus(error_data).intersection(barcodes)
+    
+    if not restricted and len(barcodes) == 1:
+        restricted = set(barcodes)
+    
+    if restricted:
+        with _unsupported_lock:
+            UNSUPPORTED_SKUS[warehouse_id].update(restricted)
+        remaining = [barcode for barcode in barcodes if barcode not in restricted]
+        if remaining:
+            clear_stocks_by_barcodes(warehouse_id, remaining)
+        return True
+    
+    if len(barcodes) <= RESTRICTED_BISECT_MIN_BATCH:
+        # В маленьком батче деление пополам уже не экономит запросы
+        for barcode in barcodes:
+            clear_stocks_by_barcodes(warehouse_id, [barcode])
+        return True
+    
+    middle = len(barcodes) // 2
+    clear_stocks_by_barcodes(warehouse_id, barcodes[:middle])
+    clear_stocks_by_barcodes(warehouse_id, barcodes[middle:])
+    return True
+
+def clear_stocks_by_barcodes(warehouse_id: int, barcodes: List[str], max_retries: int = 3,
+                             body: Optional[bytes] = None) -> bool:
     """
     Обнулить остатки по баркодам (установить amount: 0)
     
     Args:
         warehouse_id: ID склада
         barcodes: Список баркодов
-        max_retries: Максимальное количество попыток при ошибке 429
+        max_retries: Максимальное количество попыток при ошибке
+            (429 и 502/503/504 дополнительно повторяет сессия, см. get_session)
+        body: Готовое тело запроса для barcodes (build_zero_stocks_body), чтобы
+            не формировать одинаковый JSON для каждого склада
     """
+    import requests
+    
     url = f"{BASE_URL}/stocks/{warehouse_id}"
-    headers = get_headers()
+    session = get_session()
     
-    # Создаем запрос для обнуления остатков
-    stocks = [{"sku": barcode, "amount": 0} for barcode in barcodes]
+    # Не отправляем баркоды, которые этот склад уже отклонил ранее
+    with _unsupported_lock:
+        unsupported = set(UNSUPPORTED_SKUS[warehouse_id])
+    if unsupported:
+        filtered = [barcode for barcode in barcodes if barcode not in unsupported]
+        if len(filtered) != len(barcodes):
+            # Готовое тело запроса больше не соответствует списку баркодов
+            barcodes = filtered
+            body = None
+    if not barcodes:
+        return True
     
-    payload = {"stocks": stocks}
+    # Создаем запрос для обнуления остатков
+    # Тело формируется один раз - при повторных попытках отправляются те же байты
+    if body is None:
+        body = build_zero_stocks_body(barcodes)
     
     for attempt in range(max_retries):
         try:
-            response = requests.put(url, headers=headers, json=payload, timeout=60)
-            
-            # Обрабатываем 429 ошибку (Too Many Requests)
-            if response.status_code == 429:
-                wait_time = 5 * (attempt + 1)  # Увеличиваем задержку с каждой попыткой
-                print(f"    ⚠ Превышен лимит запросов (429), ожидание {wait_time} секунд...")
-                time.sleep(wait_time)
-                # Повторяем запрос после задержки
-                continue
+            # Ошибки 429 повторяет сама сессия с ожиданием по заголовку Retry-After
+            wait_for_request_slot()
+            response = session.put(url, data=body, timeout=60)
             
             # Обрабатываем 409 ошибку (Conflict) - товары ODC/LCL не подходят для склада
             if response.status_code == 409:
-                try:
-                    error_data = response.json()
-                    # Проверяем, является ли это ошибкой типа CargoWarehouseRestriction
-                    if isinstance(error_data, list) and len(error_data) > 0:
-                        error_code = error_data[0].get('code', '')
-                        if 'CargoWarehouseRestriction' in error_code:
-                            # Это не критичная ошибка - товары ODC/LCL не подходят для этого склада
-                            # Пробуем обнулить товары по одному, чтобы обнулить те, которые можно
-                            success_count = 0
-                            for barcode in barcodes:
-                                single_payload = {"stocks": [{"sku": barcode, "amount": 0}]}
-                                try:
-                                    single_response = requests.put(url, headers=headers, json=single_payload, timeout=60)
-                                    if single_response.status_code == 200:
-                                        success_count += 1
-                                    elif single_response.status_code == 409:
-                                        # Этот товар не подходит для склада - пропускаем
-                                        continue
-                                except:
-                                    pass
-                            # Возвращаем True даже если не все товары обнулились (ODC товары пропускаются)
-                            return True
-                except (ValueError, KeyError, IndexError):
-                    pass
+                error_data = get_cargo_restriction(response)
+                if error_data is not None:
+                    return clear_restricted_batch(warehouse_id, barcodes, error_data)
                 # Если не удалось распарсить ошибку, продолжаем как обычно
             
             response.raise_for_status()
             return True
         except requests.exceptions.RequestException as e:
+            resp = getattr(e, 'response', None)
+            status = resp.status_code if resp is not None else None
+            
             # Проверяем, не является ли это ошибкой 409 с CargoWarehouseRestriction
-            if hasattr(e, 'response') and e.response is not None:
-                if e.response.status_code == 409:
-                    try:
-                        error_data = e.response.json()
-                        if isinstance(error_data, list) and len(error_data) > 0:
-                            error_code = error_data[0].get('code', '')
-                            if 'CargoWarehouseRestriction' in error_code:
-                                # Это не критичная ошибка - товары ODC/LCL не подходят для склада
-                                # Пробуем обнулить товары по одному
-                                for barcode in barcodes:
-                                    single_payload = {"stocks": [{"sku": barcode, "amount": 0}]}
-                                    try:
-                                        single_response = requests.put(url, headers=headers, json=single_payload, timeout=60)
-                                        if single_response.status_code == 409:
-                                            # Этот товар не подходит для склада - пропускаем
-                                            continue
-                                    except:
-                                        pass
-                                # Возвращаем True даже если не все товары обнулились (ODC товары пропускаются)
-                                return True
-                    except (ValueError, KeyError, IndexError):
-                        pass
-                
-                # Если это последняя попытка и не 429, выводим ошибку только если это не 409 CargoWarehouseRestriction
-                if attempt == max_retries - 1:
-                    if e.response.status_code != 409:
-                        print(f"  ✗ Ошибка при обнулении остатков по баркодам: {e}")
-                        print(f"    Ответ сервера: {e.response.text}")
-                    return False
-                
-                # Если не последняя попытка и это 429, продолжаем цикл
-                if e.response.status_code == 429:
-                    wait_time = 5 * (attempt + 1)
-                    print(f"    ⚠ Превышен лимит запросов (429), ожидание {wait_time} секунд...")
-                    time.sleep(wait_time)
-                    continue
+            if status == 409:
+                error_data = get_cargo_restriction(resp)
+                if error_data is not None:
+                    return clear_restricted_batch(warehouse_id, barcodes, error_data)
             
-            # Для других ошибок на последней попытке выводим сообщение
+            # На последней попытке выводим ошибку (ошибки 409 не выводим)
             if attempt == max_retries - 1:
-                print(f"  ✗ Ошибка при обнулении остатков по баркодам: {e}")
-                if hasattr(e, 'response') and e.response is not None:
-                    print(f"    Ответ сервера: {e.response.text}")
+                if status != 409:
+                    print(f"  ✗ Ошибка при обнулении остатков по баркодам: {e}")
+                    if resp is not None:
+                        print(f"    Ответ сервера: {resp.text}")
                 return False
     
     return False
 
 def delete_stocks_by_barcodes(warehouse_id: int, barcodes: List[str]) -> bool:
     """Удалить остатки по баркодам"""
+    import requests
+    
     url = f"{BASE_URL}/stocks/{warehouse_id}"
-    headers = get_headers()
     
-    payload = {"skus": barcodes}
+    body = dumps_json({"skus": barcodes})
     
     try:
-        response = requests.delete(url, headers=headers, json=payload)
+        response = get_session().delete(url, data=body)
         response.raise_for_status()
         print(f"  ✓ Удалено остатков по баркодам: {len(barcodes)}")
         return True
     except requests.exceptions.RequestException as e:
         print(f"  ✗ Ошибка при удалении остатков по баркодам: {e}")
-        if hasattr(e.response, 'text'):
-            print(f"    Ответ сервера: {e.response.text}")
+        resp = getattr(e, 'response', None)
+        if resp is not None:
+            print(f"    Ответ сервера: {resp.text}")
         return False
 
 def clear_all_stocks():
     """Основная функция для обнуления всех остатков"""
+    import requests
+    
     # Получаем список складов
     try:
         warehouses = get_warehouses()
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при получении списка складов: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"Ответ сервера: {e.response.text}")
+        resp = getattr(e, 'response', None)
+        if resp is not None:
+            print(f"Ответ сервера: {resp.text}")
         return
     
     if not warehouses:
@@ -282,29 +523,36 @@ def clear_all_stocks():
     # Обнуляем остатки на каждом складе
     print(f"Обнуляю остатки: {len(products['barcodes']) if products['barcodes'] else len(products['nmIDs'])} товаров на {len(warehouses)} складе(ах)...")
     
-    for warehouse in warehouses:
-        warehouse_id = warehouse.get('id')
-        
-        # Используем баркоды для обнуления (если они есть)
-        if products['barcodes']:
-            # Разбиваем на батчи, чтобы не перегружать API
-            batch_size = 100
-            total_batches = (len(products['barcodes']) + batch_size - 1) // batch_size
-            for i in range(0, len(products['barcodes']), batch_size):
-                batch = products['barcodes'][i:i + batch_size]
-                batch_num = i//batch_size + 1
-                # Показываем прогресс каждые 10 батчей или последний батч
-                if batch_num % 10 == 0 or batch_num == total_batches:
-                    print(f"  Обрабатываю батч {batch_num}/{total_batches}...")
-                clear_stocks_by_barcodes(warehouse_id, batch)
-                
-                # Добавляем небольшую задержку между батчами для избежания 429 ошибок
-                if i + batch_size < len(products['barcodes']):
-                    time.sleep(0.5)
-        
-        # Если нет баркодов, но есть nmID, можно попробовать использовать их
-        # Но для этого нужен chrtId, который получается из nmID через другой API
-        # Пока оставим только работу с баркодами
+    # Используем баркоды для обнуления (если они есть)
+    # Если нет баркодов, но есть nmID, можно попробовать использовать их
+    # Но для этого нужен chrtId, который получается из nmID через другой API
+    # Пока оставим только работу с баркодами
+    barcodes = products['barcodes']
+    
+    # Разбиваем на батчи, чтобы не перегружать API. Батчи и тела запросов одинаковы
+    # для всех складов, поэтому формируем их один раз
+    batch_size = 100
+    batches = [barcodes[i:i + batch_size] for i in range(0, len(barcodes), batch_size)]
+    bodies = [build_zero_stocks_body(batch) for batch in batches]
+    
+    tasks = [
+        (warehouse.get('id'), batch, body)
+        for warehouse in warehouses
+        for batch, body in zip(batches, bodies)
+    ]
+    
+    # Отправляем батчи параллельно; частоту запросов ограничивает wait_for_request_slot
+    total_batches = len(tasks)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(clear_stocks_by_barcodes, warehouse_id, batch, body=body)
+            for warehouse_id, batch, body in tasks
+        ]
+        for batch_num, future in enumerate(as_completed(futures), start=1):
+            future.result()
+            # Показываем прогресс каждые 10 батчей или последний батч
+            if batch_num % 10 == 0 or batch_num == total_batches:
+                print(f"  Обработано батчей {batch_num}/{total_batches}...")
     
     print("Обнуление остатков завершено!")
 
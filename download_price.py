@@ -6,23 +6,47 @@
 
 import imaplib
 import email
+import email.utils
+import email.policy
+from urllib.parse import unquote
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
-from email.message import Message
+from email.message import EmailMessage
 import ssl
+import binascii
+import quopri
 import os
 from pathlib import Path
 import zipfile
+import shutil
+import tempfile
 import csv
+import io
+import codecs
+import itertools
+import mmap
 import re
-from datetime import datetime
-from typing import Tuple, List, Dict, Optional, Any
+import resource
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+from typing import Tuple, List, Dict, Optional, Any, BinaryIO, Iterator, Iterable, Pattern
 from dotenv import load_dotenv
 
+# charset-normalizer различает однобайтовые кириллические кодировки (cp1251, cp866, koi8-r);
+# если он не установлен, файл не в utf-8 считается cp1251
+try:
+    from charset_normalizer import from_bytes as detect_charsets
+except ImportError:
+    detect_charsets = None
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
+# Таблица замены запрещенных в имени файла символов: / \ : * ? " < > |
+FORBIDDEN_FILENAME_CHARS = str.maketrans({c: '_' for c in '/\\:*?"<>|'})
+
 
 class Config:
     """Класс для хранения конфигурации из переменных окружения"""
@@ -41,6 +65,53 @@ class Config:
     BASE_DIR: Path = Path(os.getenv('BASE_DIR', '/home/rinat/wildberries'))
     DOWNLOAD_DIR: Path = Path(os.getenv('DOWNLOAD_DIR', '/home/rinat/wildberries/tmp'))
     TARGET_DIR: Path = Path(os.getenv('TARGET_DIR', '/home/rinat/wildberries/price'))
+    # Папка для файлов брендов (по умолчанию совпадает с TARGET_DIR)
+    BRANDS_DIR: Path = Path(os.getenv('BRANDS_DIR') or os.getenv('TARGET_DIR', '/home/rinat/wildberries/price'))
+    
+    # Глубина поиска писем (дней): сначала ищем только среди свежих писем
+    SEARCH_DAYS: int = int(os.getenv('SEARCH_DAYS', '14'))
+    
+    # Максимальное количество писем в одной команде FETCH
+    FETCH_BATCH_SIZE: int = 500
+    
+    # Количество писем, для которых BODYSTRUCTURE запрашивается одной командой
+    STRUCTURE_BATCH_SIZE: int = 10
+    
+    # Размер куска при построчном копировании прайса без разбора CSV
+    SPLIT_CHUNK_SIZE: int = 4 * 1024 * 1024
+    
+    # Максимальный размер записи прайса с переносами строк внутри поля в кавычках, байты
+    # (как field_size_limit модуля csv: незакрытая кавычка не склеивает весь файл в одну запись)
+    MAX_RECORD_SIZE: int = 1024 * 1024
+    
+    # Максимальное число одновременно открытых файлов брендов при разбиении прайса
+    MAX_OPEN_BRAND_FILES: int = 256
+    
+    # Размер буфера записи для каждого открытого файла бренда
+    # (не больше MAX_OPEN_BRAND_FILES * BRAND_WRITE_BUFFER_SIZE памяти на буферы)
+    BRAND_WRITE_BUFFER_SIZE: int = 256 * 1024
+    
+    # Кодировки, из которых выбирается кодировка прайса не в utf-8
+    FALLBACK_ENCODINGS: List[str] = ['cp1251', 'cp866', 'koi8_r']
+    
+    # Размер начального фрагмента прайс-файла для определения кодировки и разделителя
+    SAMPLE_SIZE: int = 64 * 1024
+    
+    # Размер буфера временного файла архива и при распаковке архива
+    COPY_BUFFER_SIZE: int = 1024 * 1024
+    
+    # Максимальный размер архива, который держится в памяти без временного файла
+    SPOOL_MAX_SIZE: int = 64 * 1024 * 1024
+    
+    # Размер куска при скачивании вложения (байты закодированных данных)
+    ATTACHMENT_CHUNK_SIZE: int = 4 * 1024 * 1024
+    
+    # Количество кусков вложения, запрашиваемых одной командой FETCH
+    ATTACHMENT_CHUNKS_PER_FETCH: int = 4
+    
+    # Файл в TARGET_DIR с отметкой письма, из которого получены текущие файлы брендов
+    # (удалите его, чтобы принудительно загрузить прайс заново)
+    PRICE_STAMP_FILENAME: str = '.last_price_message'
     
     @classmethod
     def validate(cls) -> None:
@@ -88,6 +159,7 @@ def connect_imap() -> imaplib.IMAP4_SSL:
         raise Exception(f"Ошибка подключения к IMAP серверу: {e}")
 
 
+@lru_cache(maxsize=256)
 def decode_filename(filename: Optional[str]) -> Optional[str]:
     """
     Декодирует имя файла из заголовка email
@@ -101,6 +173,10 @@ def decode_filename(filename: Optional[str]) -> Optional[str]:
     if not filename:
         return None
     
+    # Имя без закодированных слов (=?charset?...?=) возвращается как есть
+    if '=?' not in filename:
+        return filename
+    
     decoded_filename = decode_header(filename)[0]
     if isinstance(decoded_filename[0], bytes):
         return decoded_filename[0].decode(decoded_filename[1] or 'utf-8')
@@ -108,67 +184,162 @@ def decode_filename(filename: Optional[str]) -> Optional[str]:
         return decoded_filename[0]
 
 
-def find_latest_message_with_attachment(imap: imaplib.IMAP4_SSL) -> Message:
+def build_message_set(email_ids: List[bytes]) -> str:
     """
-    Находит самое новое письмо от указанного отправителя с нужным вложением
+    Собирает набор сообщений IMAP, сворачивая подряд идущие номера в диапазоны
+    
+    Например, [1, 2, 3, 5, 7, 8] превращается в "1:3,5,7:8", что сокращает
+    длину команды FETCH для больших пачек писем.
     
     Args:
-        imap: Подключенный IMAP клиент
+        email_ids: Список ID писем
         
     Returns:
-        Message: Самое новое письмо с вложением
-        
-    Raises:
-        Exception: Если письмо не найдено
+        str: Набор сообщений для команды FETCH
     """
-    print(f"Поиск письма от {Config.EMAIL_FROM} с вложением {Config.ATTACHMENT_FILENAME}...")
+    numbers = sorted({int(email_id) for email_id in email_ids})
+    ranges: List[str] = []
+    start = prev = numbers[0] if numbers else 0
     
-    # Выбираем папку INBOX
-    status, _ = imap.select("INBOX")
-    if status != 'OK':
-        raise Exception("Не удалось выбрать папку INBOX")
-    
-    # Ищем письма от указанного отправителя
-    search_criteria = f'(FROM "{Config.EMAIL_FROM}")'
-    status, messages = imap.search(None, search_criteria)
-    
-    if status != 'OK' or not messages[0]:
-        raise Exception(f"Письма от {Config.EMAIL_FROM} не найдены")
-    
-    # Получаем список ID писем
-    email_ids = messages[0].split()
+    for number in numbers[1:]:
+        if number != prev + 1:
+            ranges.append(f"{start}:{prev}" if prev != start else str(start))
+            start = number
+        prev = number
     
-    if not email_ids:
-        raise Exception(f"Письма от {Config.EMAIL_FROM} не найдены")
+    if numbers:
+        ranges.append(f"{start}:{prev}" if prev != start else str(start))
     
-    print(f"Найдено писем: {len(email_ids)}")
+    return ','.join(ranges)
+
+
+def fetch_message_dates(imap: imaplib.IMAP4_SSL, email_ids: List[bytes]) -> List[Tuple[datetime, bytes]]:
+    """
+    Получает даты писем пакетными запросами FETCH (один запрос на Config.FETCH_BATCH_SIZE писем)
     
-    # Оптимизация: сначала получаем только заголовки для сортировки по дате
-    # Это экономит память, так как не загружаем полные письма
-    print("Получение заголовков писем для сортировки...")
+    Args:
+        imap: Подключенный IMAP клиент
+        email_ids: Список ID писем
+        
+    Returns:
+        List[Tuple[datetime, bytes]]: Список пар (дата, ID письма)
+    """
     email_dates: List[Tuple[datetime, bytes]] = []
     
-    for email_id in email_ids:
+    for i in range(0, len(email_ids), Config.FETCH_BATCH_SIZE):
+        batch = email_ids[i:i + Config.FETCH_BATCH_SIZE]
         try:
-            # Получаем только заголовок Date, не все письмо
-            status, date_data = imap.fetch(email_id, '(BODY[HEADER.FIELDS (DATE)])')
-            
-            if status != 'OK' or not date_data[0]:
+            # BODY.PEEK не помечает письма как прочитанные
+            status, fetch_data = imap.fetch(build_message_set(batch), '(BODY.PEEK[HEADER.FIELDS (DATE)])')
+        except Exception:
+            # Пропускаем пакет с ошибкой
+            continue
+        
+        if status != 'OK':
+            continue
+        
+        for item in fetch_data:
+            # Ответ на каждое письмо - кортеж (b'123 (BODY[HEADER.FIELDS (DATE)] {40}', b'Date: ...')
+            if not isinstance(item, tuple) or len(item) < 2:
                 continue
             
+            email_id = item[0].split(None, 1)[0]
+            
             # Парсим дату из заголовка
-            date_header = date_data[0][1].decode('utf-8', errors='ignore')
-            if date_header.startswith('Date:'):
+            date_header = item[1].decode('utf-8', errors='ignore').strip()
+            if date_header[:5].lower() == 'date:':
                 date_str = date_header[5:].strip()
                 try:
                     date_obj = parsedate_to_datetime(date_str)
+                    # Дата без часового пояса (-0000) считается UTC, чтобы даты можно было сравнивать
+                    if date_obj.tzinfo is None:
+                        date_obj = date_obj.replace(tzinfo=timezone.utc)
                     email_dates.append((date_obj, email_id))
                 except (ValueError, TypeError):
                     # Если не удалось распарсить, используем минимальную дату
-                    email_dates.append((datetime.min, email_id))
-        except Exception as e:
-            # Пропускаем письма с ошибками
-            continue
+                    email_dates.append((datetime.min.replace(tzinfo=timezone.utc), email_id))
+    
+    return email_dates
+
+
+def server_supports_sort(imap: imaplib.IMAP4_SSL) -> bool:
+    """
+    Проверяет, поддерживает ли сервер расширение SORT (RFC 5256)
+    
+    Args:
+        imap: Подключенный IMAP клиент
+        
+    Returns:
+        bool: True если сервер умеет сортировать письма сам
+    """
+    try:
+        status, data = imap.capability()
+    except imaplib.IMAP4.error:
+        return False
+    
+    if status != 'OK' or not data or not data[0]:
+        return False
+    
+    return b'SORT' in data[0].upper().split()
+
+
+def search_candidate_messages(imap: imaplib.IMAP4_SSL, recent_only: bool) -> List[Tuple[Optional[datetime], bytes]]:
+    """
+    Ищет письма от отправителя и возвращает их от новых к старым
+    
+    При recent_only ищутся только письма за последние Config.SEARCH_DAYS дней
+    (фильтр SINCE на стороне сервера), иначе - все письма отправителя.
+    Если сервер поддерживает SORT, письма сортирует сервер и даты не запрашиваются.
+    
+    Args:
+        imap: Подключенный IMAP клиент (папка уже выбрана)
+        recent_only: Искать только письма за последние Config.SEARCH_DAYS дней
+        
+    Returns:
+        List[Tuple[Optional[datetime], bytes]]: Пары (дата или None, ID письма), новые первыми
+            (пустой список, если письма не найдены)
+        
+    Raises:
+        Exception: Если не удалось получить даты найденных писем
+    """
+    search_criteria = f'FROM "{Config.EMAIL_FROM}"'
+    if recent_only:
+        # Дата в формате IMAP (01-Jan-2026); месяц задаем явно, т.к. %b зависит от локали
+        since_date = datetime.now() - timedelta(days=Config.SEARCH_DAYS)
+        months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+        since = f"{since_date.day:02d}-{months[since_date.month - 1]}-{since_date.year}"
+        search_criteria += f' SINCE {since}'
+    search_criteria = f'({search_criteria})'
+    
+    use_sort = server_supports_sort(imap)
+    if use_sort:
+        try:
+            status, messages = imap.sort('(REVERSE DATE)', 'UTF-8', search_criteria)
+        except imaplib.IMAP4.error:
+            # Сервер объявил SORT, но не выполнил его - сортируем по датам сами
+            use_sort = False
+    
+    if not use_sort:
+        status, messages = imap.search(None, search_criteria)
+    
+    if status != 'OK' or not messages or not messages[0]:
+        return []
+    
+    # Получаем список ID писем
+    email_ids = messages[0].split()
+    if not email_ids:
+        return []
+    
+    print(f"Найдено писем: {len(email_ids)}")
+    
+    if use_sort:
+        # Сервер уже отсортировал письма (самое новое первым)
+        return [(None, email_id) for email_id in email_ids]
+    
+    # Оптимизация: сначала получаем только заголовки для сортировки по дате
+    # Это экономит память, так как не загружаем полные письма
+    print("Получение заголовков писем для сортировки...")
+    email_dates = fetch_message_dates(imap, email_ids)
     
     if not email_dates:
         raise Exception(f"Не удалось получить даты писем от {Config.EMAIL_FROM}")
@@ -176,155 +347,739 @@ def find_latest_message_with_attachment(imap: imaplib.IMAP4_SSL) -> Message:
     # Сортируем по дате (самое новое первым)
     email_dates.sort(key=lambda x: x[0], reverse=True)
     print(f"Отсортировано писем по дате. Проверяю вложения, начиная с самых новых...")
+    return email_dates
+
+
+def tokenize_imap_response(data: List[Any]) -> List[Any]:
+    """
+    Разбивает ответ IMAP FETCH на токены
+    
+    imaplib возвращает литералы ({N}) отдельными элементами кортежей, поэтому
+    они сразу добавляются как строковые токены.
+    
+    Args:
+        data: Ответ imap.fetch (список bytes и кортежей (prefix, literal))
+        
+    Returns:
+        List[Any]: Токены: '(' и ')' для скобок, str для строк и атомов, None для NIL
+    """
+    tokens: List[Any] = []
+    
+    def tokenize(chunk: bytes) -> None:
+        i = 0
+        length = len(chunk)
+        while i < length:
+            char = chunk[i:i + 1]
+            if char in (b' ', b'\r', b'\n'):
+                i += 1
+            elif char in (b'(', b')'):
+                tokens.append(char.decode())
+                i += 1
+            elif char == b'"':
+                i += 1
+                value = bytearray()
+                while i < length and chunk[i:i + 1] != b'"':
+                    if chunk[i:i + 1] == b'\\' and i + 1 < length:
+                        i += 1
+                    value += chunk[i:i + 1]
+                    i += 1
+                i += 1
+                tokens.append(bytes(value).decode('utf-8', errors='replace'))
+            else:
+                start = i
+                while i < length and chunk[i:i + 1] not in (b' ', b'(', b')', b'\r', b'\n'):
+                    i += 1
+                atom = chunk[start:i].decode('utf-8', errors='replace')
+                tokens.append(None if atom.upper() == 'NIL' else atom)
+    
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item[0], item[1]
+            # Убираем маркер литерала {N} в конце префикса
+            tokenize(re.sub(rb'\{\d+\}\s*$', b'', prefix))
+            tokens.append(literal.decode('utf-8', errors='replace'))
+        elif isinstance(item, bytes):
+            tokenize(item)
+    
+    return tokens
+
+
+def parse_imap_list(tokens: List[Any]) -> List[Any]:
+    """
+    Собирает токены IMAP ответа во вложенные списки
+    
+    Args:
+        tokens: Токены из tokenize_imap_response
+        
+    Returns:
+        List[Any]: Вложенные списки, соответствующие скобкам в ответе
+        
+    Raises:
+        ValueError: Если скобки не сбалансированы
+    """
+    root: List[Any] = []
+    stack: List[List[Any]] = [root]
+    for token in tokens:
+        if token == '(':
+            child: List[Any] = []
+            stack[-1].append(child)
+            stack.append(child)
+        elif token == ')':
+            if len(stack) == 1:
+                raise ValueError("Лишняя закрывающая скобка в ответе IMAP")
+            stack.pop()
+        else:
+            stack[-1].append(token)
+    
+    if len(stack) != 1:
+        raise ValueError("Незакрытая скобка в ответе IMAP")
+    
+    return root
+
+
+def get_structure_param(params: Any, name: str) -> Optional[str]:
+    """
+    Возвращает значение параметра из списка BODYSTRUCTURE ("KEY" "value" ...)
+    
+    Учитывает параметры в формате RFC 2231 (filename*=utf-8''...).
+    
+    Args:
+        params: Список параметров или None
+        name: Имя параметра (без учета регистра)
+        
+    Returns:
+        Optional[str]: Значение параметра или None
+    """
+    if not isinstance(params, list):
+        return None
+    
+    name = name.upper()
+    for key, value in zip(params[::2], params[1::2]):
+        if not isinstance(key, str) or not isinstance(value, str):
+            continue
+        key = key.upper()
+        if key == name:
+            return value
+        if key == name + '*':
+            charset, _, text = email.utils.decode_rfc2231(value)
+            return unquote(text, encoding=charset or 'utf-8', errors='replace')
+    
+    return None
+
+
+def iter_structure_parts(structure: List[Any], prefix: str = '') -> List[Tuple[str, List[Any]]]:
+    """
+    Возвращает все конечные (не multipart) части BODYSTRUCTURE с их номерами
+    
+    Для вложенного письма (message/rfc822) возвращается и сама часть, и части
+    его тела (9-е поле части), которые нумеруются N.1, N.2 и т.д.
+    
+    Args:
+        structure: Разобранный BODYSTRUCTURE
+        prefix: Номер родительской части
+        
+    Returns:
+        List[Tuple[str, List[Any]]]: Пары (номер части для BODY[N], описание части)
+    """
+    if structure and isinstance(structure[0], list):
+        # multipart: сначала идут вложенные части, затем подтип и расширения
+        parts: List[Tuple[str, List[Any]]] = []
+        for index, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                break
+            number = f"{prefix}.{index}" if prefix else str(index)
+            parts.extend(iter_structure_parts(child, number))
+        return parts
+    
+    number = prefix or '1'
+    parts = [(number, structure)]
+    
+    # Пересланное письмо: спускаемся в его тело, вложение может быть внутри
+    if (len(structure) > 8 and isinstance(structure[0], str) and isinstance(structure[1], str)
+            and structure[0].upper() == 'MESSAGE' and structure[1].upper() == 'RFC822'
+            and isinstance(structure[8], list) and structure[8]):
+        body = structure[8]
+        if isinstance(body[0], list):
+            parts.extend(iter_structure_parts(body, number))
+        else:
+            parts.extend(iter_structure_parts(body, f"{number}.1"))
+    
+    return parts
+
+
+def fetch_bodystructures(imap: imaplib.IMAP4_SSL, email_ids: List[bytes]) -> Dict[bytes, List[Any]]:
+    """
+    Получает BODYSTRUCTURE нескольких писем одной командой FETCH
+    
+    Ответ на каждое письмо в данных imaplib - это ноль или несколько кортежей
+    (строка, литерал), за которыми следует одна строка байт; по этому признаку
+    ответ делится на части по письмам. imaplib возвращает и непрошеные ответы
+    FETCH (например, "5 (FLAGS (\\Seen))" после действий другого клиента) - части
+    без BODYSTRUCTURE пропускаются, чтобы не заменить ими ответ на запрос.
+    
+    Args:
+        imap: Подключенный IMAP клиент
+        email_ids: Список ID писем
+        
+    Returns:
+        Dict[bytes, List[Any]]: Ответ сервера для каждого ID письма
+    """
+    status, fetch_data = imap.fetch(','.join(email_id.decode() for email_id in email_ids), '(BODYSTRUCTURE)')
+    if status != 'OK' or not fetch_data:
+        return {}
+    
+    responses: Dict[bytes, List[Any]] = {}
+    current: List[Any] = []
+    for item in fetch_data:
+        current.append(item)
+        if isinstance(item, bytes):
+            # Строки ответа без литералов: в них и находится ключ BODYSTRUCTURE
+            lines = [part[0] if isinstance(part, tuple) else part for part in current]
+            if any(b'BODYSTRUCTURE' in line.upper() for line in lines):
+                responses.setdefault(lines[0].split(None, 1)[0], []).extend(current)
+            current = []
+    
+    return responses
+
+
+def find_attachment_part(fetch_data: List[Any]) -> Optional[Tuple[str, str, int]]:
+    """
+    Ищет нужное вложение по BODYSTRUCTURE письма, не загружая само письмо
+    
+    Args:
+        fetch_data: Ответ сервера на FETCH BODYSTRUCTURE для одного письма
+        
+    Returns:
+        Optional[Tuple[str, str, int]]: (номер части, Content-Transfer-Encoding,
+            размер части в байтах) или None, если вложения в письме нет
+        
+    Raises:
+        ValueError: Если ответ сервера не удалось разобрать
+    """
+    if not fetch_data:
+        raise ValueError("Сервер не вернул BODYSTRUCTURE")
+    
+    # Быстрая проверка по сырым байтам: если имени вложения нет в ответе и в нем нет
+    # закодированных (RFC 2047) или разбитых на части (RFC 2231) параметров,
+    # нужного вложения в письме нет и разбирать структуру не нужно
+    if Config.ATTACHMENT_FILENAME.isascii():
+        raw = b''.join(
+            b''.join(chunk for chunk in item if isinstance(chunk, bytes)) if isinstance(item, tuple)
+            else item if isinstance(item, bytes) else b''
+            for item in fetch_data
+        )
+        if (Config.ATTACHMENT_FILENAME.encode('ascii') not in raw
+                and b'=?' not in raw and b'*' not in raw):
+            return None
+    
+    response = parse_imap_list(tokenize_imap_response(fetch_data))
+    
+    # Ответ имеет вид: 123 (BODYSTRUCTURE (...))
+    structure = None
+    for item in response:
+        if isinstance(item, list):
+            for key, value in zip(item[::2], item[1::2]):
+                if isinstance(key, str) and key.upper() == 'BODYSTRUCTURE' and isinstance(value, list):
+                    structure = value
+    
+    if structure is None:
+        raise ValueError("В ответе нет BODYSTRUCTURE")
+    
+    for number, part in iter_structure_parts(structure):
+        if len(part) < 7:
+            continue
+        
+        # Content-Disposition находится в расширенных полях части (после 7-го поля)
+        disposition = None
+        for field in part[7:]:
+            if (isinstance(field, list) and len(field) == 2 and isinstance(field[0], str)
+                    and field[0].upper() in ('ATTACHMENT', 'INLINE')
+                    and (field[1] is None or isinstance(field[1], list))):
+                disposition = field
+                break
+        
+        if disposition is None or disposition[0].upper() != 'ATTACHMENT':
+            continue
+        
+        filename = get_structure_param(disposition[1], 'FILENAME') or get_structure_param(part[2], 'NAME')
+        if decode_filename(filename) == Config.ATTACHMENT_FILENAME:
+            encoding = part[5].upper() if isinstance(part[5], str) else '7BIT'
+            size = int(part[6]) if isinstance(part[6], str) and part[6].isdigit() else 0
+            return number, encoding, size
+    
+    return None
+
+
+def find_message_attachment(msg: EmailMessage) -> Optional[EmailMessage]:
+    """
+    Ищет нужное вложение в загруженном письме
+    
+    Перебираются только вложения (iter_attachments): текстовые и HTML-части
+    тела письма пропускаются, во вложенные multipart-части и пересланные
+    письма (message/rfc822) выполняется спуск.
+    
+    Args:
+        msg: Email сообщение (разобранное с policy=email.policy.default)
+        
+    Returns:
+        Optional[EmailMessage]: Часть с вложением или None, если вложение не найдено
+    """
+    if not msg.is_multipart():
+        return None
+    
+    for part in msg.iter_attachments():
+        if part.get_content_type() == 'message/rfc822':
+            # Пересланное письмо: iter_attachments() не возвращает его части,
+            # поэтому проверяем само вложенное письмо
+            part = part.get_payload(0)
+        
+        if part.is_multipart():
+            found = find_message_attachment(part)
+            if found is not None:
+                return found
+        elif (part.get_content_disposition() == 'attachment'
+                and part.get_filename() == Config.ATTACHMENT_FILENAME):
+            return part
+    
+    return None
+
+
+def message_has_attachment(msg: EmailMessage) -> bool:
+    """
+    Проверяет наличие нужного вложения в загруженном письме
+    
+    Args:
+        msg: Email сообщение
+        
+    Returns:
+        bool: True если вложение найдено
+    """
+    return find_message_attachment(msg) is not None
+
+
+def find_attachment_in_messages(
+    imap: imaplib.IMAP4_SSL,
+    email_dates: List[Tuple[Optional[datetime], bytes]],
+    checked_ids: set
+) -> Optional[Tuple[bytes, Optional[Tuple[str, str, int]], Optional[EmailMessage]]]:
+    """
+    Проверяет письма от новых к старым и возвращает первое письмо с нужным вложением
+    
+    Проверяются не больше 50 самых новых писем списка; письма из checked_ids
+    пропускаются, ID проверенных писем добавляются в checked_ids.
+    
+    Args:
+        imap: Подключенный IMAP клиент (папка уже выбрана)
+        email_dates: Пары (дата или None, ID письма), новые первыми
+        checked_ids: ID уже проверенных писем
+        
+    Returns:
+        Optional[Tuple[bytes, Optional[Tuple[str, str, int]], Optional[EmailMessage]]]:
+            Результат как у find_latest_message_with_attachment или None, если вложение не найдено
+    """
+    # Проверяем максимум 50 самых новых писем
+    candidates = [(date_obj, email_id) for date_obj, email_id in email_dates[:50] if email_id not in checked_ids]
+    max_check = len(candidates)
     
     # Проверяем письма в порядке от новых к старым, останавливаемся при первом найденном
     checked_count = 0
-    max_check = min(50, len(email_dates))  # Проверяем максимум 50 самых новых писем
+    structures: Dict[bytes, List[Any]] = {}
     
-    for date_obj, email_id in email_dates[:max_check]:
+    for index, (date_obj, email_id) in enumerate(candidates):
         checked_count += 1
+        checked_ids.add(email_id)
         if checked_count % 10 == 0:
             print(f"  Проверено {checked_count}/{max_check} писем...")
         
+        # BODYSTRUCTURE запрашиваем сразу для нескольких следующих писем одной командой
+        if index % Config.STRUCTURE_BATCH_SIZE == 0:
+            batch_ids = [i for _, i in candidates[index:index + Config.STRUCTURE_BATCH_SIZE]]
+            try:
+                structures = fetch_bodystructures(imap, batch_ids)
+            except imaplib.IMAP4.abort:
+                raise
+            except Exception:
+                structures = {}
+        
         try:
-            # Теперь загружаем полное письмо только для проверки вложения
-            status, msg_data = imap.fetch(email_id, '(RFC822)')
-            
-            if status != 'OK':
-                continue
-            
-            msg = email.message_from_bytes(msg_data[0][1])
-            
-            # Проверяем наличие вложения
-            has_attachment = False
-            if msg.is_multipart():
-                for part in msg.walk():
-                    if part.get_content_disposition() == 'attachment':
-                        filename = decode_filename(part.get_filename())
-                        
-                        if filename == Config.ATTACHMENT_FILENAME:
-                            has_attachment = True
-                            break
+            # Проверяем вложение по BODYSTRUCTURE (несколько сотен байт), не загружая письмо
+            msg: Optional[EmailMessage] = None
+            try:
+                part_info = find_attachment_part(structures.get(email_id, []))
+                has_attachment = part_info is not None
+            except ValueError:
+                # Не удалось разобрать BODYSTRUCTURE - проверяем по полному письму
+                part_info = None
+                status, msg_data = imap.fetch(email_id, '(RFC822)')
+                
+                if status != 'OK':
+                    continue
+                
+                msg = email.message_from_bytes(msg_data[0][1], policy=email.policy.default)
+                has_attachment = message_has_attachment(msg)
             
             if has_attachment:
-                print(f"Найдено письмо с вложением (ID: {email_id.decode()}, дата: {date_obj.strftime('%Y-%m-%d %H:%M:%S')})")
-                print(f"Проверено писем: {checked_count}")
-                return msg
+                date_info = f", дата: {date_obj.strftime('%Y-%m-%d %H:%M:%S')}" if date_obj else ""
+                print(f"Найдено письмо с вложением (ID: {email_id.decode()}{date_info})")
+                print(f"Проверено писем: {len(checked_ids)}")
+                return email_id, part_info, msg
                 
         except Exception as e:
             # Пропускаем письма с ошибками и продолжаем поиск
             continue
     
+    return None
+
+
+def find_latest_message_with_attachment(
+    imap: imaplib.IMAP4_SSL
+) -> Tuple[bytes, Optional[Tuple[str, str, int]], Optional[EmailMessage]]:
+    """
+    Находит самое новое письмо от указанного отправителя с нужным вложением
+    
+    Args:
+        imap: Подключенный IMAP клиент
+        
+    Returns:
+        Tuple[bytes, Optional[Tuple[str, str, int]], Optional[EmailMessage]]:
+            - ID письма
+            - Описание части с вложением из find_attachment_part (если BODYSTRUCTURE разобран)
+            - Полное письмо (только если BODYSTRUCTURE разобрать не удалось)
+        
+    Raises:
+        Exception: Если письмо не найдено
+    """
+    print(f"Поиск письма от {Config.EMAIL_FROM} с вложением {Config.ATTACHMENT_FILENAME}...")
+    
+    # Выбираем папку INBOX только для чтения (EXAMINE): письма не изменяются,
+    # а при завершении сессии не нужна отдельная команда CLOSE
+    status, _ = imap.select("INBOX", readonly=True)
+    if status != 'OK':
+        raise Exception("Не удалось выбрать папку INBOX")
+    
+    # Сначала проверяем свежие письма отправителя, и только если нужного вложения
+    # среди них нет - все его письма (уже проверенные письма пропускаются)
+    checked_ids: set = set()
+    checked_count = 0
+    found_messages = False
+    
+    for recent_only in (True, False):
+        if not recent_only and found_messages:
+            print("Среди свежих писем вложение не найдено, проверяю все письма отправителя...")
+        
+        # Ищем письма от указанного отправителя (новые первыми)
+        email_dates = search_candidate_messages(imap, recent_only)
+        if not email_dates:
+            continue
+        found_messages = True
+        
+        result = find_attachment_in_messages(imap, email_dates, checked_ids)
+        checked_count = len(checked_ids)
+        if result is not None:
+            return result
+    
+    if not found_messages:
+        raise Exception(f"Письма от {Config.EMAIL_FROM} не найдены")
+    
     raise Exception(f"Письмо с вложением {Config.ATTACHMENT_FILENAME} не найдено среди {checked_count} проверенных писем")
 
 
-def save_zip_attachment(msg: Message, download_dir: Path) -> Path:
+def fetch_message_stamp(imap: imaplib.IMAP4_SSL, email_id: bytes) -> str:
     """
-    Сохраняет вложение в указанную папку
+    Получает отметку письма (заголовки Message-ID и Date) для проверки, менялось ли письмо
     
     Args:
-        msg: Email сообщение
-        download_dir: Папка для сохранения
+        imap: Подключенный IMAP клиент (папка уже выбрана)
+        email_id: ID письма
         
     Returns:
-        Path: Путь к сохраненному файлу
+        str: Отметка письма или пустая строка, если заголовки получить не удалось
+    """
+    try:
+        status, fetch_data = imap.fetch(email_id, '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE)])')
+    except imaplib.IMAP4.abort:
+        raise
+    except Exception:
+        return ''
+    
+    if status != 'OK':
+        return ''
+    
+    for item in fetch_data:
+        if isinstance(item, tuple) and len(item) >= 2:
+            # Порядок заголовков и переносы строк зависят от сервера - нормализуем
+            text = item[1].decode('utf-8', errors='ignore')
+            headers = re.sub(r'\r?\n[ \t]+', ' ', text).splitlines()
+            return ' '.join(sorted(' '.join(h.split()) for h in headers if h.strip()))
+    
+    return ''
+
+
+def read_price_stamp() -> str:
+    """
+    Читает отметку письма, из которого были получены текущие файлы брендов
+    
+    Returns:
+        str: Отметка письма или пустая строка, если ее нет или файлов брендов нет
+    """
+    stamp_path = Config.TARGET_DIR / Config.PRICE_STAMP_FILENAME
+    try:
+        stamp = stamp_path.read_text(encoding='utf-8')
+    except OSError:
+        return ''
+    
+    # Без файлов брендов отметка бесполезна - прайс нужно загрузить заново
+    if next(Config.BRANDS_DIR.glob('brand_*.csv'), None) is None:
+        return ''
+    
+    return stamp
+
+
+def write_price_stamp(stamp: str) -> None:
+    """
+    Сохраняет отметку письма, из которого получены файлы брендов
+    
+    Args:
+        stamp: Отметка письма из fetch_message_stamp
+    """
+    if not stamp:
+        return
+    
+    stamp_path = Config.TARGET_DIR / Config.PRICE_STAMP_FILENAME
+    try:
+        stamp_path.write_text(stamp, encoding='utf-8')
+    except OSError as e:
+        print(f"Предупреждение: не удалось сохранить отметку письма {stamp_path}: {e}")
+
+
+def write_zip_attachment(msg: EmailMessage, out: BinaryIO) -> None:
+    """
+    Записывает вложение из загруженного письма в файловый объект
+    
+    Args:
+        msg: Email сообщение
+        out: Файловый объект для записи (открыт в бинарном режиме)
         
     Raises:
         Exception: Если вложение не найдено
     """
-    print(f"Скачивание вложения в папку {download_dir}...")
+    part = find_message_attachment(msg)
+    if part is None:
+        raise Exception(f"Вложение {Config.ATTACHMENT_FILENAME} не найдено в письме")
     
-    # Создаем папку, если её нет
-    download_dir.mkdir(parents=True, exist_ok=True)
+    encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().upper()
+    if encoding not in ('BASE64', 'QUOTED-PRINTABLE'):
+        out.write(part.get_payload(decode=True))
+        return
     
-    # Ищем вложение
-    if not msg.is_multipart():
-        raise Exception("Письмо не содержит вложений")
+    # Декодируем по кускам, не создавая в памяти вторую полную копию вложения
+    payload = part.get_payload(decode=False)
+    step = Config.COPY_BUFFER_SIZE
+    chunks = (payload[i:i + step].encode('ascii', 'surrogateescape') for i in range(0, len(payload), step))
+    write_decoded(chunks, encoding, out)
+
+
+def write_decoded(chunks: Iterable[bytes], encoding: str, out: BinaryIO) -> None:
+    """
+    Декодирует данные части письма (base64 / quoted-printable) по кускам и записывает в файл
+    
+    Args:
+        chunks: Куски закодированных данных в порядке следования
+        encoding: Content-Transfer-Encoding части (в верхнем регистре)
+        out: Файловый объект для записи (открыт в бинарном режиме)
+    """
+    carry = b''
+    
+    for chunk in chunks:
+        if encoding == 'BASE64':
+            # Декодируем только полные группы по 4 символа, остаток переносим в следующий кусок
+            data = carry + chunk.translate(None, b' \t\r\n')
+            usable = len(data) - len(data) % 4
+            out.write(binascii.a2b_base64(data[:usable]))
+            carry = data[usable:]
+        elif encoding == 'QUOTED-PRINTABLE':
+            # Декодируем только полные строки, незавершенную строку переносим дальше
+            data = carry + chunk
+            usable = data.rfind(b'\n') + 1
+            out.write(quopri.decodestring(data[:usable]))
+            carry = data[usable:]
+        else:
+            out.write(chunk)
+    
+    # Остаток после последнего куска
+    if carry:
+        if encoding == 'BASE64':
+            out.write(binascii.a2b_base64(carry))
+        else:
+            out.write(quopri.decodestring(carry))
+
+
+def iter_attachment_chunks(imap: imaplib.IMAP4_SSL, email_id: bytes,
+                           part_info: Tuple[str, str, int]) -> Iterator[bytes]:
+    """
+    Получает часть письма с вложением кусками BODY.PEEK[N]<offset.size>
+    
+    Args:
+        imap: Подключенный IMAP клиент
+        email_id: ID письма
+        part_info: (номер части, Content-Transfer-Encoding, размер) из find_attachment_part
+        
+    Yields:
+        bytes: Очередной кусок закодированных данных части
+        
+    Raises:
+        Exception: Если часть не удалось получить
+    """
+    part_number, _, part_size = part_info
+    chunk_size = Config.ATTACHMENT_CHUNK_SIZE
+    offset = 0
     
-    for part in msg.walk():
-        if part.get_content_disposition() == 'attachment':
-            filename = decode_filename(part.get_filename())
+    while True:
+        # Запрашиваем сразу несколько следующих кусков одной командой FETCH,
+        # чтобы не ждать ответа сервера на каждый кусок отдельно
+        origins = [offset + i * chunk_size for i in range(Config.ATTACHMENT_CHUNKS_PER_FETCH)]
+        if part_size:
+            origins = [origin for origin in origins if origin < part_size] or origins[:1]
+        items = ' '.join(f'BODY.PEEK[{part_number}]<{origin}.{chunk_size}>' for origin in origins)
+        status, fetch_data = imap.fetch(email_id, f'({items})')
+        if status != 'OK':
+            raise Exception(f"Не удалось получить вложение (часть {part_number})")
+        
+        # Куски могут прийти в любом порядке - раскладываем их по смещению
+        received: Dict[int, bytes] = {}
+        for item in fetch_data:
+            if isinstance(item, tuple) and len(item) >= 2:
+                match = re.search(rb'BODY\[[^\]]*\]<(\d+)>', item[0])
+                origin = int(match.group(1)) if match else origins[0]
+                received[origin] = item[1]
+        
+        for origin in origins:
+            chunk = received.get(origin, b'')
+            offset += len(chunk)
+            yield chunk
             
-            if filename == Config.ATTACHMENT_FILENAME:
-                # Сохраняем файл
-                file_path = download_dir / filename
-                
-                with open(file_path, 'wb') as f:
-                    f.write(part.get_payload(decode=True))
-                
-                print(f"Файл сохранен: {file_path}")
-                return file_path
+            if len(chunk) < chunk_size or (part_size and offset >= part_size):
+                return
+
+
+def write_attachment_part(imap: imaplib.IMAP4_SSL, email_id: bytes, part_info: Tuple[str, str, int],
+                          out: BinaryIO) -> None:
+    """
+    Скачивает часть письма с вложением в файловый объект, не загружая письмо целиком
+    
+    Часть запрашивается кусками BODY.PEEK[N]<offset.size> и декодируется
+    (base64 / quoted-printable) по мере получения, поэтому в памяти находится
+    не больше одной пачки кусков.
+    
+    Args:
+        imap: Подключенный IMAP клиент
+        email_id: ID письма
+        part_info: (номер части, Content-Transfer-Encoding, размер) из find_attachment_part
+        out: Файловый объект для записи (открыт в бинарном режиме)
+        
+    Raises:
+        Exception: Если часть не удалось получить
+    """
+    write_decoded(iter_attachment_chunks(imap, email_id, part_info), part_info[1], out)
+
+
+def extract_price_members(zip_ref: zipfile.ZipFile, target_dir: Path) -> List[Path]:
+    """
+    Распаковывает из архива только прайс-файлы (*.csv, *.txt) с большим буфером копирования
+    
+    Args:
+        zip_ref: Открытый ZIP архив
+        target_dir: Папка для распаковки
+        
+    Returns:
+        List[Path]: Пути к распакованным файлам
+    """
+    extracted: List[Path] = []
     
-    raise Exception(f"Вложение {Config.ATTACHMENT_FILENAME} не найдено в письме")
+    for info in zip_ref.infolist():
+        if info.is_dir() or not info.filename.lower().endswith(('.csv', '.txt')):
+            continue
+        
+        # Защита от путей вида ../file или /abs/file внутри архива
+        member_path = Path(info.filename)
+        if member_path.is_absolute() or '..' in member_path.parts:
+            print(f"Предупреждение: пропущен файл с небезопасным путем в архиве: {info.filename}")
+            continue
+        
+        dest_path = target_dir / member_path
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # Место под файл резервируется заранее по размеру из каталога архива.
+        # Файл открывается с буфером: куски по COPY_BUFFER_SIZE больше буфера и
+        # все равно пишутся одним вызовом, а BufferedWriter, в отличие от FileIO,
+        # дописывает остаток при частичной записи (иначе в файле остались бы нули)
+        with zip_ref.open(info) as src, open(dest_path, 'wb') as dst:
+            if info.file_size and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(dst.fileno(), 0, info.file_size)
+                except OSError:
+                    pass
+            shutil.copyfileobj(src, dst, length=Config.COPY_BUFFER_SIZE)
+        
+        extracted.append(dest_path)
+    
+    return extracted
 
 
-def unzip_and_get_price_file(zip_path: Path, target_dir: Path) -> Path:
+def extract_price_archive(archive: BinaryIO, target_dir: Path) -> Path:
     """
-    Распаковывает архив и возвращает путь к прайс-файлу
+    Распаковывает прайс-файлы из архива и возвращает путь к прайс-файлу
+    
+    Прайс-файл определяется по списку файлов архива, а не поиском в папке
+    распаковки, где могут лежать файлы от прошлых запусков.
     
     Args:
-        zip_path: Путь к ZIP архиву
+        archive: Файловый объект с ZIP архивом
         target_dir: Папка для распаковки
         
     Returns:
-        Path: Путь к прайс-файлу
+        Path: Путь к прайс-файлу (первый *.csv или *.txt файл архива)
         
     Raises:
-        Exception: Если архив не найден или прайс-файл не найден
+        Exception: Если архив поврежден, не может быть распакован или не содержит прайс-файла
     """
-    print(f"Распаковка архива {zip_path} в папку {target_dir}...")
+    print(f"Распаковка архива {Config.ATTACHMENT_FILENAME} в папку {target_dir}...")
     
     # Создаем папку, если её нет
     target_dir.mkdir(parents=True, exist_ok=True)
     
     # Распаковываем архив
     try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(target_dir)
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            extracted = extract_price_members(zip_ref, target_dir)
     except zipfile.BadZipFile:
-        raise Exception(f"Файл {zip_path} не является корректным ZIP архивом")
+        raise Exception(f"Вложение {Config.ATTACHMENT_FILENAME} не является корректным ZIP архивом")
     except Exception as e:
         raise Exception(f"Ошибка при распаковке архива: {e}")
     
     print(f"Архив распакован в {target_dir}")
     
-    # Удаляем исходный файл
-    print(f"Удаление исходного файла {zip_path}...")
-    try:
-        zip_path.unlink()
-        print("Исходный файл удален")
-    except Exception as e:
-        print(f"Предупреждение: не удалось удалить исходный файл: {e}")
+    # Исключаем файлы с префиксом brand_, чтобы не принять файл бренда за прайс
+    price_files = [f for f in extracted if not f.name.startswith("brand_")]
     
-    # Ищем прайс-файл по маске *.csv или *.txt
-    # Исключаем уже обработанные файлы с префиксом brand_
-    print("Поиск прайс-файла (*.csv или *.txt)...")
+    if not price_files:
+        raise Exception(f"Прайс-файл (*.csv или *.txt) не найден в архиве {Config.ATTACHMENT_FILENAME}")
     
-    csv_files = [f for f in target_dir.glob("*.csv") if not f.name.startswith("brand_")]
-    txt_files = [f for f in target_dir.glob("*.txt") if not f.name.startswith("brand_")]
-    
-    all_files = csv_files + txt_files
-    
-    if not all_files:
-        raise Exception(f"Прайс-файл (*.csv или *.txt) не найден в {target_dir}")
-    
-    # Сортируем по времени модификации (самый новый первым) и берем первый
-    all_files.sort(key=lambda f: f.stat().st_mtime, reverse=True)
-    
-    price_file = all_files[0]
+    price_file = price_files[0]
     print(f"Найден прайс-файл: {price_file}")
     
     return price_file
 
 
-def cleanup_old_brand_files(target_dir: Path) -> None:
+def cleanup_old_brand_files(target_dir: Path, keep: Optional[set] = None) -> None:
     """
-    Удаляет старые файлы брендов (brand_*.csv) перед обработкой нового файла
+    Удаляет старые файлы брендов (brand_*.csv)
     
     Args:
         target_dir: Папка с файлами брендов
+        keep: Имена файлов, которые нужно оставить
     """
-    brand_files = list(target_dir.glob("brand_*.csv"))
+    brand_files = [f for f in target_dir.glob("brand_*.csv") if not keep or f.name not in keep]
     if brand_files:
         for brand_file in brand_files:
             try:
@@ -333,6 +1088,29 @@ def cleanup_old_brand_files(target_dir: Path) -> None:
                 print(f"Предупреждение: не удалось удалить {brand_file}: {e}")
 
 
+def publish_brand_files(staging_dir: Path, output_dir: Path) -> None:
+    """
+    Переносит подготовленные файлы брендов из временной папки в рабочую
+    
+    Каждый файл заменяется атомарно (os.replace), поэтому читатель видит либо
+    старую, либо новую версию файла бренда целиком. Файлы брендов, которых нет
+    в новом прайсе, удаляются после переноса.
+    
+    Args:
+        staging_dir: Временная папка с новыми файлами брендов
+        output_dir: Рабочая папка файлов брендов
+    """
+    new_names: set = set()
+    for staged_file in staging_dir.iterdir():
+        os.replace(staged_file, output_dir / staged_file.name)
+        new_names.add(staged_file.name)
+    
+    staging_dir.rmdir()
+    
+    # Удаляем файлы брендов, оставшиеся от предыдущих прайсов
+    cleanup_old_brand_files(output_dir, keep=new_names)
+
+
 def sanitize_filename(brand: str) -> str:
     """
     Заменяет запрещенные символы в имени файла на _
@@ -343,41 +1121,39 @@ def sanitize_filename(brand: str) -> str:
     Returns:
         str: Очищенное имя файла
     """
-    # Запрещенные символы: / \ : * ? " < > |
-    forbidden_chars = r'[/\\:*?"<>|]'
-    return re.sub(forbidden_chars, '_', brand)
+    return brand.translate(FORBIDDEN_FILENAME_CHARS)
 
 
-def detect_encoding(price_path: Path) -> str:
+def detect_encoding_from_sample(sample: bytes) -> str:
     """
-    Определяет кодировку файла
+    Определяет кодировку по начальному фрагменту файла
     
     Args:
-        price_path: Путь к файлу
+        sample: Первые байты файла
         
     Returns:
-        str: Кодировка файла (utf-8 или cp1251)
+        str: Кодировка файла (utf-8, cp1251 или другая однобайтовая кириллическая)
+        
+    Raises:
+        UnicodeDecodeError: Если фрагмент не декодируется ни в одной из кодировок
     """
-    # Пробуем сначала utf-8
+    # Пробуем сначала utf-8; неполный многобайтовый символ в конце фрагмента не считается ошибкой
     try:
-        with open(price_path, 'r', encoding='utf-8') as f:
-            # Читаем первые строки для проверки
-            for i, _ in enumerate(f):
-                if i >= 10:
-                    break
-        encoding = 'utf-8'
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
     except UnicodeDecodeError:
-        # Если не получилось, пробуем cp1251
-        encoding = 'cp1251'
-        try:
-            with open(price_path, 'r', encoding='cp1251') as f:
-                for i, _ in enumerate(f):
-                    if i >= 10:
-                        break
-        except UnicodeDecodeError:
-            raise Exception(f"Не удалось определить кодировку файла {price_path}")
+        pass
+    
+    # Выбираем только из кодировок, совместимых с ASCII: разделители и кавычки
+    # ищутся в байтах файла
+    if detect_charsets is not None:
+        best = detect_charsets(sample, cp_isolation=Config.FALLBACK_ENCODINGS).best()
+        if best is not None:
+            return best.encoding
     
-    return encoding
+    # Если не получилось, пробуем cp1251
+    sample.decode('cp1251')
+    return 'cp1251'
 
 
 def detect_delimiter(sample: str) -> csv.Dialect:
@@ -399,10 +1175,183 @@ def detect_delimiter(sample: str) -> csv.Dialect:
     return dialect
 
 
-def split_price_by_brand(price_path: Path, output_dir: Path) -> None:
+def write_brand_rows(batch_writes: List[Tuple[Any, List[bytes]]], files_to_close: List[Any]) -> None:
     """
-    Разбивает прайс-файл по брендам (первая колонка)
-    Оптимизировано для работы с большими файлами - записывает построчно, не загружая все в память
+    Записывает строки пачки в файлы брендов
+    
+    Строки бренда склеиваются в один блок и записываются одним вызовом,
+    а не построчно через буфер файла.
+    
+    Args:
+        batch_writes: Пары (функция записи в файл бренда, строки бренда)
+        files_to_close: Файлы, которые нужно закрыть после записи пачки
+    """
+    for write, rows in batch_writes:
+        write(b''.join(rows))
+    
+    for out_f in files_to_close:
+        out_f.close()
+
+
+def map_file(price_f: BinaryIO) -> Optional[mmap.mmap]:
+    """
+    Отображает файл в память только для чтения
+    
+    Args:
+        price_f: Файл, открытый в бинарном режиме
+        
+    Returns:
+        Optional[mmap.mmap]: Отображение файла или None для пустого файла
+    """
+    if os.fstat(price_f.fileno()).st_size == 0:
+        return None
+    
+    return mmap.mmap(price_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def get_brand_file_limit() -> int:
+    """
+    Возвращает число файлов брендов, которые можно держать открытыми одновременно
+    
+    Кроме открытых файлов в LRU, до конца записи пачки открытыми остаются и
+    вытесненные из него, поэтому под файлы брендов отводится не больше
+    половины мягкого лимита дескрипторов процесса (за вычетом запаса).
+    
+    Returns:
+        int: Config.MAX_OPEN_BRAND_FILES, ограниченный лимитом RLIMIT_NOFILE
+    """
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return Config.MAX_OPEN_BRAND_FILES
+    
+    return max(1, min(Config.MAX_OPEN_BRAND_FILES, (soft_limit - 64) // 2))
+
+
+def build_record_patterns(delimiter: bytes, quote: bytes) -> Tuple[Pattern[bytes], Pattern[bytes], Pattern[bytes]]:
+    """
+    Строит регулярные выражения для записи CSV, продолжения записи и поля в кавычках
+    
+    Правила совпадают с разбором модуля csv (doublequote, strict=False): кавычка
+    открывает поле только в его начале, внутри поля в кавычках "" - это кавычка,
+    после закрывающей кавычки символы до разделителя добавляются к полю как есть.
+    Закрывающей считается кавычка, за которой нет второй кавычки, поэтому строка,
+    оканчивающаяся на "", остается внутри поля - как и в модуле csv.
+    
+    Args:
+        delimiter: Разделитель полей в кодировке файла
+        quote: Символ кавычки в кодировке файла
+        
+    Returns:
+        Tuple[Pattern[bytes], Pattern[bytes], Pattern[bytes]]: (полная строка-запись,
+            строка, продолжающая незакрытое поле в кавычках и завершающая запись,
+            поле в кавычках в начале записи)
+    """
+    d = re.escape(delimiter)
+    q = re.escape(quote)
+    # Остаток поля в кавычках после открывающей кавычки
+    quoted_rest = rb'(?:[^' + q + rb']|' + q + q + rb')*' + q + rb'(?!' + q + rb')[^' + d + rb'\r\n]*'
+    quoted = q + quoted_rest
+    unquoted = rb'(?:[^' + d + q + rb'\r\n][^' + d + rb'\r\n]*)?'
+    field = rb'(?:' + quoted + rb'|' + unquoted + rb')'
+    fields_tail = rb'(?:' + d + field + rb')*(?:\r\n|\n|\r)?'
+    return re.compile(field + fields_tail), re.compile(quoted_rest + fields_tail), re.compile(quoted)
+
+
+def iter_record_batches(price_f: BinaryIO, record_pattern: Pattern[bytes],
+                        continuation_pattern: Pattern[bytes], quote: bytes) -> Iterator[List[bytes]]:
+    """
+    Читает файл кусками и возвращает пачки полных записей CSV (байты вместе с переводом строки)
+    
+    Обычно запись - это одна строка. Если в строке есть кавычки и поле в кавычках
+    не закрыто до конца строки (перенос строки внутри значения), к записи
+    присоединяются следующие строки, пока она не станет полной. Каждая
+    присоединенная строка проверяется отдельно (закрывает ли она поле), поэтому
+    время разбора не растет квадратично с длиной записи.
+    
+    Args:
+        price_f: Файл, открытый в бинарном режиме, или его отображение в память
+        record_pattern: Регулярное выражение полной записи из build_record_patterns
+        continuation_pattern: Регулярное выражение строки, завершающей запись, из build_record_patterns
+        quote: Символ кавычки в кодировке файла
+        
+    Yields:
+        List[bytes]: Записи очередного куска файла
+        
+    Raises:
+        Exception: Если запись с незакрытой кавычкой больше Config.MAX_RECORD_SIZE
+    """
+    carry = b''
+    # Строки незаконченной записи и их общий размер
+    pending: List[bytes] = []
+    pending_size = 0
+    
+    def collect(lines: List[bytes]) -> List[bytes]:
+        """Собирает записи из строк, присоединяя строки незакрытых полей в кавычках"""
+        nonlocal pending_size
+        records: List[bytes] = []
+        for line in lines:
+            if pending:
+                # Запись внутри поля в кавычках: достаточно проверить только новую строку
+                if continuation_pattern.fullmatch(line) is None:
+                    pending.append(line)
+                    pending_size += len(line)
+                    if pending_size > Config.MAX_RECORD_SIZE:
+                        raise Exception(
+                            f"Запись прайса длиннее {Config.MAX_RECORD_SIZE} байт: "
+                            f"вероятно, не закрыта кавычка в записи, начинающейся с {pending[0][:100]!r}"
+                        )
+                    continue
+                pending.append(line)
+                records.append(b''.join(pending))
+                pending.clear()
+                continue
+            if quote in line and record_pattern.fullmatch(line) is None:
+                pending.append(line)
+                pending_size = len(line)
+                continue
+            records.append(line)
+        return records
+    
+    while True:
+        chunk = price_f.read(Config.SPLIT_CHUNK_SIZE)
+        if not chunk:
+            break
+        
+        data = carry + chunk
+        cut = data.rfind(b'\n') + 1
+        carry = data[cut:]
+        if cut:
+            lines = data[:cut].splitlines(keepends=True)
+            # Кусок без кавычек: каждая строка - отдельная запись
+            yield collect(lines) if pending or quote in data else lines
+    
+    if carry:
+        # Последняя строка файла может быть без перевода строки
+        added_newline = not carry.endswith(b'\r')
+        if added_newline:
+            carry += b'\n'
+        yield collect(carry.splitlines(keepends=True))
+        
+        # Добавленный перевод строки не должен попасть внутрь незакрытого поля в кавычках
+        if pending and added_newline:
+            pending[-1] = pending[-1][:-1]
+    
+    # Незакрытое до конца файла поле в кавычках - как в модуле csv, это последняя запись
+    if pending:
+        yield [b''.join(pending)]
+
+
+def write_brand_files(price_path: Path, output_dir: Path) -> None:
+    """
+    Разбивает прайс-файл по брендам (первая колонка) и записывает файлы брендов в папку
+    
+    Файл отображается в память и читается кусками: iter_record_batches собирает
+    из каждого куска пачку полных записей (регулярными выражениями, с учетом
+    переносов строк внутри полей в кавычках). Записи копируются в файлы брендов
+    как есть, без разбора всех полей и повторного форматирования CSV: из записи
+    выделяется только первое поле. Внутри пачки записи группируются по брендам,
+    и группы записываются в фоновом потоке, пока основной поток собирает
+    следующую пачку. Весь файл в памяти не накапливается.
     
     Args:
         price_path: Путь к прайс-файлу
@@ -411,98 +1360,185 @@ def split_price_by_brand(price_path: Path, output_dir: Path) -> None:
     Raises:
         Exception: Если файл не может быть прочитан
     """
-    print(f"Разбиение прайс-файла {price_path} по брендам...")
-    
-    # Определяем кодировку
-    encoding = detect_encoding(price_path)
+    # Файл открывается и отображается в память один раз: кодировка и разделитель
+    # определяются по начальному фрагменту отображения, затем то же отображение
+    # читается с начала как источник записей
+    price_f = open(price_path, 'rb')
+    price_map: Optional[mmap.mmap] = None
     
-    # Читаем первые строки для определения разделителя
-    sample_lines: List[str] = []
-    with open(price_path, 'r', encoding=encoding) as f:
-        for i, line in enumerate(f):
-            if i >= 10:
-                break
-            sample_lines.append(line)
-    sample = ''.join(sample_lines)
+    try:
+        price_map = map_file(price_f)
+        head = price_map[:Config.SAMPLE_SIZE] if price_map is not None else b''
+        
+        # Определяем кодировку
+        try:
+            encoding = detect_encoding_from_sample(head)
+        except UnicodeDecodeError:
+            raise Exception(f"Не удалось определить кодировку файла {price_path}")
+        
+        # Берем первые строки фрагмента для определения разделителя
+        head_text = codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+        sample = ''.join(head_text.splitlines(keepends=True)[:10])
+        
+        # Определяем разделитель
+        dialect = detect_delimiter(sample)
+    except Exception:
+        if price_map is not None:
+            price_map.close()
+        price_f.close()
+        raise
     
-    # Определяем разделитель
-    dialect = detect_delimiter(sample)
+    delimiter = dialect.delimiter.encode(encoding)
+    quote = dialect.quotechar.encode(encoding)
+    record_pattern, continuation_pattern, quoted_field_pattern = build_record_patterns(delimiter, quote)
     
-    # Словарь для отслеживания открытых файлов и писателей для каждого бренда
-    brand_writers: Dict[str, Any] = {}
+    # Открытые файлы брендов в порядке последнего использования:
+    # при превышении лимита самый давно не использованный файл закрывается
+    # и при следующей строке бренда открывается заново в режиме дозаписи
+    brand_writers: "OrderedDict[str, BinaryIO]" = OrderedDict()
     brand_files: Dict[str, Path] = {}
     header: Optional[List[str]] = None
+    header_line: bytes = b''
     row_count = 0
     processed_brands: set = set()
     
+    # Файлы, вытесненные из brand_writers и ожидающие закрытия
+    evicted_files: List[Any] = []
+    max_open_files = get_brand_file_limit()
+    
+    # Нормализованный ключ и исходное название бренда для каждого
+    # встреченного значения первой колонки (в байтах, как в файле)
+    brand_keys: Dict[bytes, Tuple[str, str]] = {}
+    
+    def get_brand_key(raw_brand: bytes) -> Tuple[str, str]:
+        """Возвращает нормализованный ключ и название бренда для значения первой колонки"""
+        brand = raw_brand.decode(encoding)
+        if raw_brand.startswith(quote):
+            # Значение в кавычках разбираем модулем csv
+            brand = next(csv.reader(io.StringIO(brand), dialect=dialect), [''])[0]
+        # Нормализуем название бренда: убираем только лишние пробелы (но сохраняем регистр)
+        # Это поможет группировать "JapanParts" и "JapanParts " как один бренд
+        result = brand_keys[raw_brand] = (' '.join(brand.split()), brand.strip())
+        return result
+    
+    def get_brand_writer(brand_key: str, brand: str) -> Any:
+        """Возвращает функцию записи в файл бренда, открывая файл при необходимости"""
+        out_f = brand_writers.get(brand_key)
+        if out_f is not None:
+            brand_writers.move_to_end(brand_key)
+            return out_f.write
+        
+        is_new_brand = brand_key not in brand_files
+        if is_new_brand:
+            # Используем оригинальное название для имени файла
+            sanitized_brand = sanitize_filename(brand)
+            brand_files[brand_key] = output_dir / f"brand_{sanitized_brand}.csv"
+            processed_brands.add(brand_key)
+        
+        # Освобождаем дескриптор самого давно не использованного бренда; файл
+        # закрывается после записи текущей пачки, в которую он еще может входить
+        if len(brand_writers) >= max_open_files:
+            evicted_files.append(brand_writers.popitem(last=False)[1])
+        
+        # Новый файл создаем, ранее закрытый - открываем для дозаписи
+        out_f = open(
+            brand_files[brand_key],
+            'wb' if is_new_brand else 'ab',
+            buffering=Config.BRAND_WRITE_BUFFER_SIZE
+        )
+        if is_new_brand:
+            # Записываем заголовок сразу
+            out_f.write(header_line)
+        
+        brand_writers[brand_key] = out_f
+        return out_f.write
+    
     try:
-        with open(price_path, 'r', encoding=encoding) as f:
-            reader = csv.reader(f, dialect=dialect)
+        # Пустой файл не отображается в память - читаем его как обычно
+        source: Any = price_f
+        if price_map is not None:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                price_map.madvise(mmap.MADV_SEQUENTIAL)
+            source = price_map
+        
+        batches = iter_record_batches(source, record_pattern, continuation_pattern, quote)
+        first_batch = next(batches, [])
+        
+        # Первая запись - заголовок
+        if first_batch:
+            header_line = first_batch.pop(0)
+            header = next(csv.reader(io.StringIO(header_line.decode(encoding)), dialect=dialect), None)
+        
+        # Записи обрабатываются пачками: внутри пачки группируются по брендам
+        # и записываются одним вызовом на бренд. Запись пачки выполняется
+        # в отдельном потоке, пока основной поток читает следующую
+        with ThreadPoolExecutor(max_workers=1) as write_executor:
+            pending_write: Optional[Future] = None
             
-            for row_num, row in enumerate(reader):
-                if not row:
-                    continue
-                
-                # Первая строка - заголовок
-                if row_num == 0:
-                    header = row
-                    continue
-                
-                # Первая колонка - бренд
-                if len(row) == 0:
-                    continue
-                
-                brand = row[0].strip()
-                
-                if not brand:
-                    continue
-                
-                # Нормализуем название бренда: убираем только лишние пробелы (но сохраняем регистр)
-                # Это поможет группировать "JapanParts" и "JapanParts " как один бренд
-                brand_key = ' '.join(brand.split())
+            # Локальные имена для внутреннего цикла по записям
+            match_quoted_field = quoted_field_pattern.match
+            brand_keys_get = brand_keys.get
+            
+            for batch in itertools.chain([first_batch], batches):
+                batch_groups: Dict[str, List[bytes]] = {}
+                batch_names: Dict[str, str] = {}
+                batch_groups_get = batch_groups.get
                 
-                # Создаем файл и писатель для бренда, если его еще нет
-                if brand_key not in brand_writers:
-                    # Используем оригинальное название для имени файла
-                    sanitized_brand = sanitize_filename(brand)
-                    brand_file_path = output_dir / f"brand_{sanitized_brand}.csv"
-                    brand_files[brand_key] = brand_file_path
+                for row in batch:
+                    # Первая колонка - бренд; значение в кавычках может содержать разделитель
+                    # (у последней записи файла кавычка может быть не закрыта - тогда
+                    # значение берется до разделителя, как у поля без кавычек)
+                    quoted_field = match_quoted_field(row) if row.startswith(quote) else None
+                    if quoted_field is not None:
+                        raw_brand = quoted_field.group()
+                    else:
+                        raw_brand = row.partition(delimiter)[0]
                     
-                    # Открываем файл для записи
-                    out_f = open(brand_file_path, 'w', encoding=encoding, newline='')
-                    writer = csv.writer(
-                        out_f,
-                        delimiter=dialect.delimiter,
-                        quotechar=dialect.quotechar,
-                        doublequote=True,
-                        quoting=csv.QUOTE_ALL,
-                        escapechar=None
-                    )
+                    brand_key, brand = brand_keys_get(raw_brand) or get_brand_key(raw_brand)
+                    if not brand_key:
+                        continue
                     
-                    # Записываем заголовок сразу
-                    writer.writerow(header)
-                    
-                    brand_writers[brand_key] = {
-                        'file': out_f,
-                        'writer': writer
-                    }
-                    processed_brands.add(brand_key)
+                    rows = batch_groups_get(brand_key)
+                    if rows is None:
+                        rows = batch_groups[brand_key] = []
+                        batch_names[brand_key] = brand
+                    rows.append(row)
+                
+                # Дожидаемся записи предыдущей пачки: открытие новых файлов
+                # может закрыть файл, в который она еще пишется
+                if pending_write is not None:
+                    pending_write.result()
                 
-                # Записываем строку сразу в файл бренда (не накапливаем в памяти)
-                brand_writers[brand_key]['writer'].writerow(row)
-                row_count += 1
+                # Записываем пачку в файлы брендов (не накапливаем весь файл в памяти)
+                batch_writes = [
+                    (get_brand_writer(brand_key, batch_names[brand_key]), rows)
+                    for brand_key, rows in batch_groups.items()
+                ]
+                pending_write = write_executor.submit(write_brand_rows, batch_writes, evicted_files)
+                evicted_files = []
+                
+                previous_count = row_count
+                row_count += sum(len(rows) for rows in batch_groups.values())
                 
                 # Показываем прогресс каждые 100000 строк
-                if row_count % 100000 == 0:
+                if row_count // 100000 > previous_count // 100000:
                     print(f"  Обработано строк: {row_count}, брендов: {len(processed_brands)}")
+            
+            if pending_write is not None:
+                pending_write.result()
     
     finally:
         # Закрываем все открытые файлы
-        for brand_key, writer_data in brand_writers.items():
+        for brand_key, out_f in brand_writers.items():
             try:
-                writer_data['file'].close()
+                out_f.close()
             except Exception as e:
                 print(f"  Предупреждение: ошибка при закрытии файла для бренда {brand_key}: {e}")
+        for out_f in evicted_files:
+            out_f.close()
+        if price_map is not None:
+            price_map.close()
+        price_f.close()
     
     if not header:
         raise Exception("Файл не содержит заголовка")
@@ -511,6 +1547,97 @@ def split_price_by_brand(price_path: Path, output_dir: Path) -> None:
     print(f"Создано файлов по брендам: {len(brand_files)}")
 
 
+def split_price_by_brand(price_path: Path, output_dir: Path) -> None:
+    """
+    Разбивает прайс-файл по брендам (первая колонка)
+    
+    Файлы брендов сначала записываются во временную папку внутри output_dir
+    и переносятся в output_dir только после успешного разбиения, поэтому
+    при ошибке остаются файлы от предыдущего запуска.
+    
+    Args:
+        price_path: Путь к прайс-файлу
+        output_dir: Папка для сохранения файлов по брендам
+        
+    Raises:
+        Exception: Если файл не может быть прочитан
+    """
+    print(f"Разбиение прайс-файла {price_path} по брендам...")
+    
+    staging_dir = output_dir / f".tmp-{os.getpid()}"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True)
+    
+    try:
+        write_brand_files(price_path, staging_dir)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    
+    publish_brand_files(staging_dir, output_dir)
+    print(f"Файлы брендов сохранены в {output_dir}")
+
+
+def fetch_and_extract(imap: imaplib.IMAP4_SSL, target_dir: Path) -> Tuple[Optional[Path], str]:
+    """
+    Находит самое новое письмо с вложением, распаковывает архив и возвращает путь к прайс-файлу
+    
+    Архив не сохраняется отдельным файлом: вложение декодируется во временный
+    буфер в памяти (на диск он переносится только при превышении SPOOL_MAX_SIZE)
+    и распаковывается прямо из него. Если письмо то же, из которого получены
+    текущие файлы брендов, вложение не скачивается.
+    
+    Args:
+        imap: Подключенный IMAP клиент
+        target_dir: Папка для распаковки
+        
+    Returns:
+        Tuple[Optional[Path], str]: Путь к прайс-файлу (None, если письмо не изменилось) и отметка письма
+    """
+    # Находим письмо с вложением
+    email_id, part_info, msg = find_latest_message_with_attachment(imap)
+    
+    # Сравниваем письмо с тем, из которого получены текущие файлы брендов
+    stamp = fetch_message_stamp(imap, email_id)
+    if stamp and stamp == read_price_stamp():
+        print("Письмо не изменилось с прошлой загрузки, файлы брендов актуальны")
+        return None, stamp
+    
+    print(f"Скачивание вложения {Config.ATTACHMENT_FILENAME}...")
+    
+    # Создаем папку для временного файла, если её нет
+    Config.DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    
+    # Если по BODYSTRUCTURE уже известно, что архив не поместится в буфер памяти,
+    # сразу пишем во временный файл, чтобы не копировать данные при переполнении буфера
+    expected_size = 0
+    if part_info is not None:
+        expected_size = part_info[2] * 3 // 4 if part_info[1] == 'BASE64' else part_info[2]
+    
+    # Буфер временного файла того же размера, что и при распаковке: zipfile читает
+    # заголовки и сжатые данные архива небольшими порциями
+    if expected_size > Config.SPOOL_MAX_SIZE:
+        archive_file = tempfile.TemporaryFile(buffering=Config.COPY_BUFFER_SIZE, dir=Config.DOWNLOAD_DIR)
+    else:
+        archive_file = tempfile.SpooledTemporaryFile(
+            max_size=Config.SPOOL_MAX_SIZE,
+            buffering=Config.COPY_BUFFER_SIZE,
+            dir=Config.DOWNLOAD_DIR
+        )
+    
+    with archive_file as archive:
+        # Скачиваем вложение: по возможности только нужную часть письма
+        if part_info is not None:
+            write_attachment_part(imap, email_id, part_info, archive)
+        else:
+            write_zip_attachment(msg, archive)
+        
+        print(f"Вложение получено: {archive.tell()} байт")
+        
+        archive.seek(0)
+        return extract_price_archive(archive, target_dir), stamp
+
+
 def main() -> None:
     """Основная функция"""
     imap: Optional[imaplib.IMAP4_SSL] = None
@@ -521,20 +1648,23 @@ def main() -> None:
         # Подключаемся к IMAP
         imap = connect_imap()
         
-        # Находим письмо с вложением
-        msg = find_latest_message_with_attachment(imap)
-        
-        # Скачиваем вложение
-        zip_path = save_zip_attachment(msg, Config.DOWNLOAD_DIR)
-        
-        # Распаковываем и получаем путь к прайс-файлу
-        price_file = unzip_and_get_price_file(zip_path, Config.TARGET_DIR)
-        
-        # Очищаем старые файлы брендов перед обработкой нового файла
-        cleanup_old_brand_files(Config.TARGET_DIR)
+        # Находим письмо, скачиваем и распаковываем вложение; при обрыве
+        # соединения сервером переподключаемся один раз и повторяем поиск
+        try:
+            price_file, stamp = fetch_and_extract(imap, Config.TARGET_DIR)
+        except imaplib.IMAP4.abort as e:
+            print(f"Соединение с IMAP сервером прервано ({e}), переподключение...")
+            try:
+                imap.shutdown()
+            except Exception:
+                pass
+            imap = connect_imap()
+            price_file, stamp = fetch_and_extract(imap, Config.TARGET_DIR)
         
-        # Разбиваем прайс по брендам
-        split_price_by_brand(price_file, Config.TARGET_DIR)
+        if price_file is not None:
+            # Разбиваем прайс по брендам (старые файлы брендов заменяются после успешного разбиения)
+            split_price_by_brand(price_file, Config.BRANDS_DIR)
+            write_price_stamp(stamp)
         
         print("\nОперация завершена успешно!")
         
@@ -549,7 +1679,6 @@ def main() -> None:
         # Закрываем соединение
         if imap:
             try:
-                imap.close()
                 imap.logout()
                 print("Соединение с IMAP сервером закрыто")
             except Exception:
@@ -156,34 +156,21 @@ def run_step(step_num: int, step_name: str, step_func, *args, **kwargs) -> bool:
     print("=" * 60)
     
     try:
-        # Сохраняем оригинальный sys.exit для перехвата
-        original_exit = sys.exit
-        
-        def custom_exit(code=0):
-            """Перехватывает sys.exit и преобразует в исключение"""
-            if code != 0:
-                raise SystemExit(code)
-        
-        sys.exit = custom_exit
-        
-        try:
-            if args or kwargs:
-                step_func(*args, **kwargs)
-            else:
-                step_func()
-            print(f"\n✓ Шаг {step_num} выполнен успешно")
-            return True
-        finally:
-            # Восстанавливаем оригинальный sys.exit
-            sys.exit = original_exit
-            
+        if args or kwargs:
+            step_func(*args, **kwargs)
+        else:
+            step_func()
+        print(f"\n✓ Шаг {step_num} выполнен успешно")
+        return True
     except KeyboardInterrupt:
         print(f"\n⚠ Шаг {step_num} прерван пользователем")
         return False
     except SystemExit as e:
-        if e.code != 0:
+        # sys.exit() внутри шага: код 0 или None - успешное завершение
+        if e.code:
             print(f"\n✗ Шаг {step_num} завершился с ошибкой (код: {e.code})")
             return False
+        print(f"\n✓ Шаг {step_num} выполнен успешно")
         return True
     except Exception as e:
         print(f"\n✗ Ошибка на шаге {step_num}: {e}")
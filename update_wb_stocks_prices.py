@@ -6,14 +6,45 @@
 
 import os
 import requests
-import pandas as pd
+import openpyxl
 from dotenv import load_dotenv
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Callable, Iterator
 import csv
+import hashlib
+import io
+import json
+import pickle
 import re
 import time
+import threading
+from dataclasses import dataclass
 from datetime import datetime
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson сериализует JSON заметно быстрее стандартного json; если он не установлен,
+# используем стандартную библиотеку
+try:
+    import orjson
+    
+    def dumps_json(data: Any) -> bytes:
+        """Сериализовать данные в JSON (bytes)"""
+        return orjson.dumps(data)
+except ImportError:
+    def dumps_json(data: Any) -> bytes:
+        """Сериализовать данные в JSON (bytes)"""
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+# charset-normalizer различает однобайтовые кириллические кодировки (cp1251, cp866, koi8-r);
+# если он не установлен, файл не в utf-8 считается cp1251
+try:
+    from charset_normalizer import from_bytes as detect_charsets
+except ImportError:
+    detect_charsets = None
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -29,6 +60,8 @@ class Config:
     
     # Пути
     TARGET_DIR: Path = Path(os.getenv('TARGET_DIR', '/home/rinat/wildberries/price'))
+    # Папка с файлами брендов (по умолчанию совпадает с TARGET_DIR)
+    BRANDS_DIR: Path = Path(os.getenv('BRANDS_DIR') or os.getenv('TARGET_DIR', '/home/rinat/wildberries/price'))
     BASE_DIR: Path = Path(os.getenv('BASE_DIR', '/home/rinat/wildberries'))
     
     # Бренды для обработки
@@ -37,9 +70,37 @@ class Config:
     # Коэффициент повышения цены
     PRICE_MULTIPLIER: float = 1.6
     
+    # Склад, на котором обновляются остатки
+    STOCKS_WAREHOUSE_ID: int = 1619436
+    
     # Артикулы, которые не выгружаются в остатки (цены обновляются)
     EXCLUDED_FROM_STOCKS: List[str] = ['W14e', 'W14LM-U']
     
+    # Размер батча при отправке остатков и цен
+    BATCH_SIZE: int = 100
+    
+    # Количество параллельных потоков для отправки батчей
+    MAX_WORKERS: int = 8
+    
+    # Минимальный интервал между запросами к API (общий для всех потоков), секунды
+    REQUEST_INTERVAL: float = 0.5
+    
+    # Размер буфера чтения xlsx файлов, байты
+    XLSX_READ_BUFFER_SIZE: int = 1 << 20
+    
+    # Кодировки, из которых выбирается кодировка файла бренда не в utf-8
+    # (файлы брендов сохраняются в кодировке исходного прайса)
+    FALLBACK_ENCODINGS: List[str] = ['cp1251', 'cp866', 'koi8_r']
+    
+    # Размер начального фрагмента файла бренда для определения кодировки, байты
+    ENCODING_SAMPLE_SIZE: int = 64 * 1024
+    
+    # Папка кэша разобранных файлов соответствия
+    CACHE_DIR: Path = Path.home() / ".cache" / "wb"
+    
+    # Версия формата кэша соответствий: увеличить при изменении разбора файла баркодов
+    MAPPING_CACHE_VERSION: int = 1
+    
     @classmethod
     def validate(cls) -> None:
         """Проверяет, что все необходимые переменные окружения установлены"""
@@ -47,6 +108,44 @@ class Config:
             raise ValueError("WB_API_TOKEN не установлен в .env файле")
 
 
+@dataclass
+class Product:
+    """Товар из файла бренда"""
+    
+    # __slots__ вместо __dict__ у каждого экземпляра: товаров в файлах брендов десятки тысяч
+    __slots__ = ('manufacturer_art', 'seller_art', 'barcode', 'price', 'amount')
+    
+    manufacturer_art: Optional[str]  # Артикул производителя из CSV
+    seller_art: Optional[str]  # Артикул продавца (будет найден через соответствие)
+    barcode: Optional[str]
+    price: float
+    amount: int
+
+
+_rate_lock = threading.Lock()
+_next_request_time = 0.0
+
+
+def wait_for_request_slot() -> None:
+    """
+    Ограничивает частоту запросов к API для всех потоков сразу
+    
+    Каждый вызов резервирует следующий свободный слот с шагом Config.REQUEST_INTERVAL
+    и ждет его наступления, чтобы параллельная отправка не приводила к ошибкам 429.
+    """
+    global _next_request_time
+    
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_request_time)
+        _next_request_time = slot + Config.REQUEST_INTERVAL
+    
+    delay = slot - now
+    if delay > 0:
+        time.sleep(delay)
+
+
+@lru_cache(maxsize=1)
 def get_api_token() -> str:
     """
     Получить API токен из .env файла
@@ -70,8 +169,9 @@ def get_api_token() -> str:
     return token
 
 
+@lru_cache(maxsize=1)
 def get_headers() -> Dict[str, str]:
-    """Получить заголовки для API запросов"""
+    """Получить заголовки для API запросов (вычисляются один раз за процесс)"""
     token = get_api_token()
     return {
         "Authorization": f"Bearer {token}",
@@ -79,12 +179,55 @@ def get_headers() -> Dict[str, str]:
     }
 
 
+@lru_cache(maxsize=1)
+def get_session() -> requests.Session:
+    """
+    Получить общую HTTP сессию для API запросов
+    
+    Сессия переиспользует TCP/TLS соединения (keep-alive) между запросами
+    и повторяет идемпотентные запросы (GET, PUT) при превышении лимита (429)
+    и временных ошибках сервера (500/502/503/504). Загрузка цен (POST создает
+    задачу) повторяется только при 429 и ошибках соединения: после 500 или
+    обрыва ответа задача могла быть уже создана. Пауза перед повтором берется
+    из заголовка Retry-After, а если его нет - растет экспоненциально (backoff_factor).
+    
+    Returns:
+        requests.Session: Сессия с заголовками авторизации
+    """
+    session = requests.Session()
+    session.headers.update(get_headers())
+    
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    
+    # Отдельный адаптер для API цен (выбирается по самому длинному префиксу URL)
+    prices_retry = Retry(
+        total=5,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429],
+        allowed_methods=frozenset(['POST']),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    prices_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=prices_retry)
+    session.mount(Config.PRICES_API_URL, prices_adapter)
+    
+    return session
+
+
 def get_warehouses() -> List[Dict[str, Any]]:
     """Получить список складов продавца"""
     url = f"{Config.STOCKS_API_URL}/warehouses"
-    headers = get_headers()
     
-    response = requests.get(url, headers=headers)
+    response = get_session().get(url, timeout=60)
     response.raise_for_status()
     
     warehouses = response.json()
@@ -95,6 +238,138 @@ def get_warehouses() -> List[Dict[str, Any]]:
     return warehouses
 
 
+def clean_art(art: str) -> str:
+    """
+    Приводит артикул к виду без пробелов в верхнем регистре (AG 01007 -> AG01007)
+    
+    Args:
+        art: Артикул
+        
+    Returns:
+        str: Артикул без пробелов в верхнем регистре
+    """
+    return art.replace(' ', '').upper()
+
+
+def normalize_art(art: str) -> str:
+    """
+    Нормализует артикул для сопоставления: без пробелов, дефисов, слэшей и подчеркиваний, в верхнем регистре
+    
+    Args:
+        art: Артикул
+        
+    Returns:
+        str: Нормализованный артикул
+    """
+    return clean_art(str(art).strip()).replace('-', '').replace('/', '').replace('_', '')
+
+
+def build_normalized_index(mapping: Dict[str, str]) -> Dict[str, str]:
+    """
+    Строит словарь {нормализованный артикул: значение} для поиска без перебора всех ключей
+    
+    Если несколько ключей нормализуются одинаково, берется первый ключ
+    в порядке словаря - как при последовательном переборе mapping.items().
+    
+    Args:
+        mapping: Словарь {артикул: значение}
+        
+    Returns:
+        Dict[str, str]: Словарь {нормализованный артикул: значение}
+    """
+    index: Dict[str, str] = {}
+    for art_key, value in mapping.items():
+        index.setdefault(normalize_art(art_key), value)
+    return index
+
+
+def iter_barcode_rows(barcode_file: str) -> Iterator[Tuple[Any, Any, Any]]:
+    """
+    Читает строки данных файла баркодов в потоковом режиме (openpyxl read_only)
+    
+    Строки 1-4 - шапка, строка 5 - заголовок таблицы; возвращаются строки с 6-й.
+    
+    Args:
+        barcode_file: Путь к xlsx файлу
+        
+    Yields:
+        Tuple[Any, Any, Any]: Значения колонок B (артикул производителя), C (nmID) и G (баркод)
+    """
+    # Открываем файл с большим буфером: zipfile читает сжатые данные листа
+    # небольшими порциями, и крупный буфер сокращает число системных вызовов read()
+    with open(barcode_file, 'rb', buffering=Config.XLSX_READ_BUFFER_SIZE) as f:
+        wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            # Размер листа из файла (тег dimension) бывает неверным, и в режиме
+            # read_only строки дальше него не читаются - определяем размер по данным
+            ws.reset_dimensions()
+            
+            # Строки дополняются пустыми значениями до колонки G: если колонок
+            # в листе меньше, баркод пустой и строка пропускается
+            for row in ws.iter_rows(min_row=6, max_col=7, values_only=True):
+                yield row[1], row[2], row[6]
+        finally:
+            wb.close()
+
+
+def get_mapping_cache_path(barcode_file: str) -> Path:
+    """
+    Путь к файлу кэша соответствий для файла баркодов
+    
+    Имя кэша зависит от пути, размера и времени изменения файла, поэтому
+    после замены или изменения файла баркодов старый кэш не используется.
+    
+    Args:
+        barcode_file: Путь к файлу баркодов
+        
+    Returns:
+        Path: Путь к файлу кэша
+    """
+    stat = os.stat(barcode_file)
+    key = f"{Config.MAPPING_CACHE_VERSION}:{os.path.abspath(barcode_file)}:{stat.st_mtime_ns}:{stat.st_size}"
+    key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    return Config.CACHE_DIR / f"mapping_{key_hash}.pkl"
+
+
+def load_cached_mapping(barcode_file: str) -> Optional[Tuple[Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, str]]]:
+    """
+    Прочитать соответствия из кэша
+    
+    Args:
+        barcode_file: Путь к файлу баркодов
+        
+    Returns:
+        Optional[Tuple[...]]: Словари в формате read_mapping_files или None, если кэша нет
+    """
+    try:
+        with open(get_mapping_cache_path(barcode_file), 'rb') as f:
+            mapping = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+    
+    return mapping if isinstance(mapping, tuple) and len(mapping) == 5 else None
+
+
+def save_cached_mapping(barcode_file: str, mapping: Tuple[Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, str]]) -> None:
+    """
+    Сохранить соответствия в кэш (ошибки записи не критичны)
+    
+    Args:
+        barcode_file: Путь к файлу баркодов
+        mapping: Словари в формате read_mapping_files
+    """
+    try:
+        cache_path = get_mapping_cache_path(barcode_file)
+        tmp_path = cache_path.with_suffix('.tmp')
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(mapping, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Предупреждение: не удалось сохранить кэш соответствий: {e}")
+
+
 def read_mapping_files() -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, str], Dict[str, str]]:
     """
     Читает файл соответствия "Баркоды.xlsx"
@@ -139,69 +414,70 @@ def read_mapping_files() -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]
     if not barcode_file:
         # Если приоритетных файлов нет, ищем любой файл с "Баркоды"
         for search_dir in search_dirs:
-            try:
-                for file in os.listdir(search_dir):
-                    if 'Баркоды' in file and file.endswith('.xlsx'):
-                        barcode_file = os.path.join(search_dir, file) if search_dir != '.' else file
-                        break
-                if barcode_file:
-                    break
-            except (OSError, PermissionError):
-                continue
+            found = next(Path(search_dir).glob('*Баркоды*.xlsx'), None)
+            if found is not None:
+                barcode_file = str(found)
+                break
     
     if barcode_file:
+        # Соответствия из этого же файла (тот же размер и время изменения) берем из кэша
+        cached = load_cached_mapping(barcode_file)
+        if cached is not None:
+            return cached
+        
         try:
-            # Читаем файл, пропуская первые 4 строки (данные начинаются с 5-й строки)
-            df_barcode = pd.read_excel(barcode_file, header=0, skiprows=4)
-            
-            # Структура файла (данные с 5-й строки):
+            # Структура файла:
+            # Строки 1-4 - шапка, строка 5 - заголовок таблицы, данные с 6-й строки
             # Колонка B (индекс 1) - артикул производителя
             # Колонка C (индекс 2) - nmID (артикул WB)
             # Колонка G (индекс 6) - баркод
-            if len(df_barcode.columns) >= 7:
-                manufacturer_art_col = df_barcode.columns[1]  # Колонка B - артикул производителя
-                nmid_col = df_barcode.columns[2]  # Колонка C - nmID
-                barcode_col = df_barcode.columns[6]  # Колонка G - баркод
-                
-                for idx, row in df_barcode.iterrows():
+            for manufacturer_art_val, nmid_val, barcode_val in iter_barcode_rows(barcode_file):
+                try:
+                    manufacturer_art = '' if manufacturer_art_val is None else str(manufacturer_art_val).strip()
+                    barcode = '' if barcode_val is None else str(barcode_val).strip()
+                    
+                    # Пропускаем заголовки и пустые значения
+                    if manufacturer_art.lower() in ['артикул', 'артикул производителя', 'nan', ''] or not manufacturer_art:
+                        continue
+                    
+                    if nmid_val is None or not barcode or barcode.lower() in ['баркод', 'barcode', 'баркод в системе', 'nan', ''] or len(barcode) <= 5:
+                        continue
+                    
+                    # Получаем nmID из колонки C (openpyxl обычно уже возвращает int,
+                    # через float приводятся только числа с плавающей точкой и строки)
                     try:
-                        manufacturer_art = str(row[manufacturer_art_col]).strip() if len(row) > 1 else None
-                        nmid_val = row[nmid_col]
-                        barcode = str(row[barcode_col]).strip()
+                        if type(nmid_val) is int:
+                            nmid = str(nmid_val)
+                        else:
+                            nmid = str(int(float(nmid_val))).strip()
+                    except (ValueError, TypeError):
+                        continue
+                    
+                    if nmid and barcode:
+                        # Создаем соответствие артикул производителя -> nmID
+                        # Сохраняем все варианты: оригинальный, без пробелов, нормализованный
+                        manufacturer_art_clean = clean_art(manufacturer_art)
+                        manufacturer_art_normalized = manufacturer_art_clean.replace('-', '').replace('/', '').replace('_', '')
                         
-                        # Пропускаем заголовки и пустые значения
-                        if manufacturer_art.lower() in ['артикул', 'артикул производителя', 'nan', ''] or not manufacturer_art:
-                            continue
+                        art_to_nmid[manufacturer_art] = nmid  # Оригинальный вариант
+                        art_to_nmid[manufacturer_art_clean] = nmid  # Без пробелов
+                        art_to_nmid[manufacturer_art_normalized] = nmid  # Нормализованный
+                        manufacturer_art_to_nmid[manufacturer_art_clean] = nmid
                         
-                        if pd.isna(nmid_val) or not barcode or barcode.lower() in ['баркод', 'barcode', 'баркод в системе', 'nan', ''] or len(barcode) <= 5:
-                            continue
+                        # Создаем соответствие баркод -> nmID
+                        barcode_to_nmid[barcode] = nmid
                         
-                        # Получаем nmID из колонки C
-                        try:
-                            nmid = str(int(float(nmid_val))).strip()
-                        except (ValueError, TypeError):
-                            continue
-                        
-                        if nmid and barcode:
-                            # Создаем соответствие артикул производителя -> nmID
-                            # Сохраняем все варианты: оригинальный, без пробелов, нормализованный
-                            manufacturer_art_clean = manufacturer_art.replace(' ', '').upper()
-                            manufacturer_art_normalized = manufacturer_art_clean.replace('-', '').replace('/', '').replace('_', '')
-                            
-                            art_to_nmid[manufacturer_art] = nmid  # Оригинальный вариант
-                            art_to_nmid[manufacturer_art_clean] = nmid  # Без пробелов
-                            art_to_nmid[manufacturer_art_normalized] = nmid  # Нормализованный
-                            manufacturer_art_to_nmid[manufacturer_art_clean] = nmid
-                            
-                            # Создаем соответствие баркод -> nmID
-                            barcode_to_nmid[barcode] = nmid
-                            
-                            # Создаем соответствие артикул производителя -> баркод
-                            manufacturer_art_to_barcode[manufacturer_art] = barcode  # Оригинальный вариант
-                            manufacturer_art_to_barcode[manufacturer_art_clean] = barcode  # Без пробелов
-                            manufacturer_art_to_barcode[manufacturer_art_normalized] = barcode  # Нормализованный
-                    except (ValueError, TypeError, KeyError, IndexError):
-                        continue
+                        # Создаем соответствие артикул производителя -> баркод
+                        manufacturer_art_to_barcode[manufacturer_art] = barcode  # Оригинальный вариант
+                        manufacturer_art_to_barcode[manufacturer_art_clean] = barcode  # Без пробелов
+                        manufacturer_art_to_barcode[manufacturer_art_normalized] = barcode  # Нормализованный
+                except (ValueError, TypeError, KeyError, IndexError):
+                    continue
+            
+            save_cached_mapping(
+                barcode_file,
+                (art_to_nmid, barcode_to_nmid, manufacturer_art_to_nmid, manufacturer_art_to_barcode, barcode_to_chrtid)
+            )
         except Exception as e:
             print(f"Ошибка при чтении файла баркодов: {e}")
             import traceback
@@ -212,45 +488,25 @@ def read_mapping_files() -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]
     return art_to_nmid, barcode_to_nmid, manufacturer_art_to_nmid, manufacturer_art_to_barcode, barcode_to_chrtid
 
 
-def get_chrt_id_by_barcode(barcode: str, warehouse_id: int, stocks_cache: Optional[Dict[str, int]] = None) -> Optional[int]:
+def detect_encoding(sample: bytes) -> str:
     """
-    Получить chrtId по баркоду через API или из кэша
-    
-    Примечание: API может не поддерживать GET с параметром sku, поэтому возвращаем None.
-    API сам найдет chrtId по sku при обновлении остатков через PUT запрос.
+    Определяет однобайтовую кодировку файла, который не декодируется как utf-8
     
     Args:
-        barcode: Баркод товара
-        warehouse_id: ID склада
-        stocks_cache: Кэш остатков {barcode: chrtId}
+        sample: Начальный фрагмент файла
         
     Returns:
-        Optional[int]: chrtId или None (API найдет автоматически)
+        str: Кодировка из Config.FALLBACK_ENCODINGS (cp1251, если определить не удалось)
     """
-    # API не поддерживает получение chrtId через GET запрос с параметром sku
-    # Возвращаем None - API сам найдет chrtId по sku при обновлении остатков
-    return None
-
-
-def get_all_stocks(warehouse_id: int) -> Dict[str, int]:
-    """
-    Получить все остатки со склада и создать кэш {barcode: chrtId}
-    
-    Примечание: API может не поддерживать получение всех остатков сразу,
-    поэтому возвращаем пустой кэш и будем получать chrtId по требованию.
+    if detect_charsets is not None:
+        best = detect_charsets(sample, cp_isolation=Config.FALLBACK_ENCODINGS).best()
+        if best is not None:
+            return best.encoding
     
-    Args:
-        warehouse_id: ID склада
-        
-    Returns:
-        Dict[str, int]: Словарь {barcode: chrtId} (обычно пустой)
-    """
-    # API не поддерживает GET /stocks/{warehouse_id} без параметров
-    # Будем получать chrtId по требованию через параметр sku
-    return {}
+    return 'cp1251'
 
 
-def read_brand_file(brand: str) -> List[Dict[str, Any]]:
+def read_brand_file(brand: str) -> List[Product]:
     """
     Читает файл бренда и извлекает данные
     
@@ -258,34 +514,34 @@ def read_brand_file(brand: str) -> List[Dict[str, Any]]:
         brand: Название бренда
         
     Returns:
-        List[Dict[str, Any]]: Список товаров с данными
+        List[Product]: Список товаров с данными
     """
-    brand_file = Config.TARGET_DIR / f"brand_{brand}.csv"
+    brand_file = Config.BRANDS_DIR / f"brand_{brand}.csv"
     
-    if not brand_file.exists():
+    try:
+        # Файл бренда читается с диска один раз: кодировка, разделитель и строки
+        # определяются по уже прочитанному содержимому
+        data = brand_file.read_bytes()
+    except FileNotFoundError:
         return []
     
     products = []
     
-    # Определяем кодировку и разделитель
-    encoding = 'utf-8'
+    # Определяем кодировку
     try:
-        with open(brand_file, 'r', encoding='utf-8') as f:
-            sample = f.read(1000)
+        text = data.decode('utf-8')
     except UnicodeDecodeError:
-        encoding = 'cp1251'
-        with open(brand_file, 'r', encoding='cp1251') as f:
-            sample = f.read(1000)
+        text = data.decode(detect_encoding(data[:Config.ENCODING_SAMPLE_SIZE]))
     
-    # Определяем разделитель
+    # Определяем разделитель по началу файла
     sniffer = csv.Sniffer()
     try:
-        dialect = sniffer.sniff(sample, delimiters=',;\t')
-    except:
+        dialect = sniffer.sniff(text[:1000], delimiters=',;\t')
+    except csv.Error:
         dialect = csv.excel
     
-    # Читаем файл
-    with open(brand_file, 'r', encoding=encoding) as f:
+    # Разбираем строки (переводы строк приводятся к \n, как при чтении файла в текстовом режиме)
+    with io.StringIO(text, newline=None) as f:
         reader = csv.reader(f, dialect=dialect)
         
         header = None
@@ -342,7 +598,7 @@ def read_brand_file(brand: str) -> List[Dict[str, Any]]:
                     if (potential_manufacturer_art.lower() not in ['бренд', 'brand', 'артикул', 'артикул продавца', 'название', 'name', 'nan', '', 'none'] and
                         len(potential_manufacturer_art) >= 2 and len(potential_manufacturer_art) <= 20):
                         # Убираем пробелы для сопоставления (AG 01007 -> AG01007)
-                        manufacturer_art_clean = potential_manufacturer_art.replace(' ', '').upper()
+                        manufacturer_art_clean = clean_art(potential_manufacturer_art)
                         
                         # Для бренда SANGSIN: фильтруем артикулы - должны начинаться на SP и заканчиваться на цифру
                         if brand.upper() == 'SANGSIN':
@@ -355,17 +611,17 @@ def read_brand_file(brand: str) -> List[Dict[str, Any]]:
                 if len(row) > 2 and row[2]:
                     potential_barcode = str(row[2]).strip().replace('"', '').replace("'", '').replace(' ', '').replace('-', '')
                     # Если это длинный баркод (13+ цифр) - EAN-13
-                    if len(potential_barcode) >= 13 and potential_barcode.isdigit():
+                    # isascii() отсекает юникодные цифры (например, '١٢٣'), которые isdigit() тоже пропускает
+                    if len(potential_barcode) >= 13 and potential_barcode.isascii() and potential_barcode.isdigit():
                         barcode = potential_barcode
                 
-                products.append({
-                    'manufacturer_art': manufacturer_art,  # Артикул производителя из CSV
-                    'seller_art': seller_art,  # Артикул продавца (будет найден через соответствие)
-                    'barcode': barcode,
-                    'price': price,
-                    'amount': amount,
-                    'row': row
-                })
+                products.append(Product(
+                    manufacturer_art=manufacturer_art,
+                    seller_art=seller_art,
+                    barcode=barcode,
+                    price=price,
+                    amount=amount
+                ))
             except (ValueError, IndexError, TypeError) as e:
                 continue
     
@@ -384,20 +640,12 @@ def update_stocks(warehouse_id: int, stocks_data: List[Dict[str, Any]]) -> bool:
         bool: True если успешно
     """
     url = f"{Config.STOCKS_API_URL}/stocks/{warehouse_id}"
-    headers = get_headers()
     
     payload = {"stocks": stocks_data}
     
     try:
-        response = requests.put(url, headers=headers, json=payload, timeout=60)
-        
-        # Обрабатываем 429 ошибку (Too Many Requests)
-        if response.status_code == 429:
-            print(f"    ⚠ Превышен лимит запросов (429), ожидание 5 секунд...")
-            time.sleep(5)
-            # Повторяем запрос после задержки
-            response = requests.put(url, headers=headers, json=payload, timeout=60)
-        
+        # Ошибки 429 повторяет сама сессия с ожиданием по заголовку Retry-After
+        response = get_session().put(url, data=dumps_json(payload), timeout=60)
         response.raise_for_status()
         return True
     except requests.exceptions.RequestException as e:
@@ -418,7 +666,6 @@ def update_prices(prices_data: List[Dict[str, Any]]) -> bool:
         bool: True если успешно
     """
     url = f"{Config.PRICES_API_URL}/upload/task"
-    headers = get_headers()
     
     # Формируем данные в правильном формате (как в update_prices_stocks_wb.py)
     # Удаляем дубликаты nmID - оставляем последнее значение для каждого nmID
@@ -445,15 +692,8 @@ def update_prices(prices_data: List[Dict[str, Any]]) -> bool:
     payload = {"data": data_items}
     
     try:
-        # API требует POST, а не PUT
-        response = requests.post(url, headers=headers, json=payload, timeout=120)
-        
-        # Обрабатываем 429 ошибку (Too Many Requests)
-        if response.status_code == 429:
-            print(f"    ⚠ Превышен лимит запросов (429), ожидание 5 секунд...")
-            time.sleep(5)
-            # Повторяем запрос после задержки
-            response = requests.post(url, headers=headers, json=payload, timeout=120)
+        # API требует POST, а не PUT; ошибки 429 повторяет сама сессия
+        response = get_session().post(url, data=dumps_json(payload), timeout=120)
         
         # Обрабатываем 400 ошибки - некоторые не критичны
         if response.status_code == 400:
@@ -497,6 +737,62 @@ def update_prices(prices_data: List[Dict[str, Any]]) -> bool:
         return False
 
 
+def calculate_new_price(price: float, multiplier: Fraction) -> int:
+    """
+    Вычисляет новую цену с наценкой, отбрасывая дробную часть
+    
+    Цена переводится в копейки и умножается на коэффициент как на точную дробь,
+    чтобы ошибки округления float не уменьшали цену на рубль
+    (например, 100.00 * 1.15 = 114.99999999999999).
+    
+    Args:
+        price: Цена из файла бренда
+        multiplier: Коэффициент повышения цены в виде дроби
+        
+    Returns:
+        int: Новая цена в рублях
+    """
+    kopecks = round(price * 100)
+    return kopecks * multiplier.numerator // (multiplier.denominator * 100)
+
+
+def send_batches(label: str, items: List[Dict[str, Any]], send_batch: Callable[[List[Dict[str, Any]]], bool]) -> int:
+    """
+    Отправляет данные батчами по Config.BATCH_SIZE в несколько потоков
+    
+    Запросы всех потоков проходят через общий ограничитель частоты wait_for_request_slot.
+    
+    Args:
+        label: Название данных для вывода прогресса
+        items: Данные для отправки
+        send_batch: Функция отправки одного батча, возвращает True при успехе
+        
+    Returns:
+        int: Количество батчей, которые не удалось отправить
+    """
+    batches = [items[i:i + Config.BATCH_SIZE] for i in range(0, len(items), Config.BATCH_SIZE)]
+    total_batches = len(batches)
+    
+    def send(batch: List[Dict[str, Any]]) -> bool:
+        wait_for_request_slot()
+        return send_batch(batch)
+    
+    failed = 0
+    with ThreadPoolExecutor(max_workers=Config.MAX_WORKERS) as executor:
+        futures = [executor.submit(send, batch) for batch in batches]
+        for batch_num, future in enumerate(as_completed(futures), 1):
+            if not future.result():
+                failed += 1
+            # Показываем прогресс каждые 10 батчей или последний батч
+            if batch_num % 10 == 0 or batch_num == total_batches:
+                print(f"  {label}: батч {batch_num}/{total_batches}...")
+    
+    if failed:
+        print(f"  ⚠ {label}: не удалось отправить батчей: {failed} из {total_batches}")
+    
+    return failed
+
+
 def main() -> None:
     """Основная функция"""
     try:
@@ -516,6 +812,8 @@ def main() -> None:
         print("Ошибка: не найдено складов")
         return
     
+    warehouses_by_id = {w.get('id'): w for w in warehouses}
+    
     # Читаем файлы соответствия
     art_to_nmid, barcode_to_nmid, manufacturer_art_to_nmid, manufacturer_art_to_barcode, barcode_to_chrtid = read_mapping_files()
     
@@ -523,12 +821,20 @@ def main() -> None:
         print("⚠ Предупреждение: не найдено файлов соответствия")
     
     # Обрабатываем каждый бренд
-    excluded_from_stocks_normalized = {
-        a.replace(' ', '').upper().replace('-', '').replace('/', '').replace('_', '')
-        for a in Config.EXCLUDED_FROM_STOCKS
-    }
+    excluded_from_stocks_normalized = {normalize_art(a) for a in Config.EXCLUDED_FROM_STOCKS}
+    
+    # Словари по нормализованным артикулам (дефисы, слэши и т.д. убраны) для поиска
+    # артикулов, не найденных напрямую
+    art_to_nmid_normalized = build_normalized_index(art_to_nmid)
+    art_to_barcode_normalized = build_normalized_index(manufacturer_art_to_barcode)
+    
+    # Коэффициент наценки в виде точной дроби (1.6 -> 8/5)
+    price_multiplier = Fraction(str(Config.PRICE_MULTIPLIER))
 
-    all_stocks_data: Dict[int, List[Dict[str, Any]]] = {}  # {warehouse_id: [stocks]}
+    # Остатки обновляются на одном складе (Config.STOCKS_WAREHOUSE_ID), поэтому данные
+    # собираются сразу в один словарь {баркод: запись}: батчи отправляются параллельно,
+    # и при повторе баркода, как при последовательной отправке, действует последнее значение
+    stocks_by_sku: Dict[str, Dict[str, Any]] = {}
     all_prices_data: List[Dict[str, Any]] = []
 
     for brand in Config.BRANDS:
@@ -544,12 +850,12 @@ def main() -> None:
             
             # Проверяем только артикулы, которые есть в файле "Баркоды.xlsx"
             # Если артикула нет в файле соответствия, пропускаем товар
-            if not product.get('manufacturer_art'):
+            if not product.manufacturer_art:
                 continue
             
-            manufacturer_art = str(product['manufacturer_art']).strip()
-            manufacturer_art_clean = manufacturer_art.replace(' ', '').upper()
-            manufacturer_art_normalized = manufacturer_art_clean.replace('-', '').replace('/', '').replace('_', '')
+            manufacturer_art = product.manufacturer_art.strip()
+            manufacturer_art_clean = clean_art(manufacturer_art)
+            manufacturer_art_normalized = normalize_art(manufacturer_art_clean)
             
             # Проверяем, есть ли артикул в файле соответствия
             art_found = False
@@ -559,14 +865,10 @@ def main() -> None:
             elif manufacturer_art_clean in art_to_nmid:
                 nmid = art_to_nmid[manufacturer_art_clean]
                 art_found = True
-            else:
+            elif manufacturer_art_normalized in art_to_nmid_normalized:
                 # Пробуем найти с учетом нормализации (убираем дефисы, слэши и т.д.)
-                for art_key, art_nmid in art_to_nmid.items():
-                    art_key_normalized = str(art_key).strip().replace(' ', '').upper().replace('-', '').replace('/', '').replace('_', '')
-                    if art_key_normalized == manufacturer_art_normalized:
-                        nmid = art_nmid
-                        art_found = True
-                        break
+                nmid = art_to_nmid_normalized[manufacturer_art_normalized]
+                art_found = True
             
             # Если артикул не найден в файле соответствия, пропускаем товар
             # (это означает, что карточка еще не создана на WB)
@@ -576,7 +878,7 @@ def main() -> None:
             matched_count += 1
             
             # Подготавливаем данные для обновления цен
-            new_price = int(product['price'] * Config.PRICE_MULTIPLIER)
+            new_price = calculate_new_price(product.price, price_multiplier)
             all_prices_data.append({
                 "nmID": int(nmid),
                 "price": new_price,
@@ -584,12 +886,6 @@ def main() -> None:
             })
             
             # Подготавливаем данные для обновления остатков
-            # Обновляем остатки только на складе 1619436
-            TARGET_WAREHOUSE_ID = 1619436
-            
-            if TARGET_WAREHOUSE_ID not in all_stocks_data:
-                all_stocks_data[TARGET_WAREHOUSE_ID] = []
-            
             # Получаем баркод для обновления остатков из файла соответствия (колонка G)
             # Баркод всегда берем из файла "Баркоды.xlsx", так как артикул уже проверен
             barcode_for_stock = None
@@ -599,11 +895,7 @@ def main() -> None:
                 barcode_for_stock = manufacturer_art_to_barcode[manufacturer_art_clean]
             else:
                 # Пробуем нормализованный вариант
-                for art_key, barcode_val in manufacturer_art_to_barcode.items():
-                    art_key_normalized = str(art_key).strip().replace(' ', '').upper().replace('-', '').replace('/', '').replace('_', '')
-                    if art_key_normalized == manufacturer_art_normalized:
-                        barcode_for_stock = barcode_val
-                        break
+                barcode_for_stock = art_to_barcode_normalized.get(manufacturer_art_normalized)
             
             # Не выгружаем в остатки исключённые артикулы (цены для них обновляются)
             skip_stock = manufacturer_art_normalized in excluded_from_stocks_normalized
@@ -611,69 +903,38 @@ def main() -> None:
             if barcode_for_stock and not skip_stock:
                 # Используем только sku - API сам найдет chrtId по sku при обновлении остатков
                 # Это соответствует логике из update_prices_stocks_wb.py
-                all_stocks_data[TARGET_WAREHOUSE_ID].append({
+                stocks_by_sku[barcode_for_stock] = {
                     "sku": barcode_for_stock,
-                    "amount": product['amount']
-                })
+                    "amount": product.amount
+                }
         
         if matched_count > 0:
             print(f"  {brand}: обработано {matched_count} товаров")
     
-    if not all_stocks_data and not all_prices_data:
+    if not stocks_by_sku and not all_prices_data:
         print("\n⚠ Не найдено данных для обновления")
         return
     
     # Выводим информацию о том, что будет обновлено
-    total_stocks = sum(len(stocks) for stocks in all_stocks_data.values())
-    print(f"\nОбновляю: остатков {total_stocks}, цен {len(all_prices_data)}")
+    print(f"\nОбновляю: остатков {len(stocks_by_sku)}, цен {len(all_prices_data)}")
     
-    # Обновляем остатки только на складе 1619436
-    TARGET_WAREHOUSE_ID = 1619436
+    # Обновляем остатки только на складе Config.STOCKS_WAREHOUSE_ID
+    warehouse_id = Config.STOCKS_WAREHOUSE_ID
     
-    if TARGET_WAREHOUSE_ID in all_stocks_data:
-        stocks_data = all_stocks_data[TARGET_WAREHOUSE_ID]
-        warehouse = next((w for w in warehouses if w.get('id') == TARGET_WAREHOUSE_ID), None)
+    if stocks_by_sku:
+        warehouse = warehouses_by_id.get(warehouse_id)
         warehouse_name = warehouse.get('name', 'Неизвестный склад') if warehouse else 'Неизвестный склад'
+        print(f"\nСклад: {warehouse_name} (ID: {warehouse_id})")
         
-        # Разбиваем на батчи по 100
-        batch_size = 100
-        total_batches = (len(stocks_data) + batch_size - 1) // batch_size
-        for i in range(0, len(stocks_data), batch_size):
-            batch = stocks_data[i:i + batch_size]
-            batch_num = i//batch_size + 1
-            # Показываем прогресс каждые 10 батчей или последний батч
-            if batch_num % 10 == 0 or batch_num == total_batches:
-                print(f"  Остатки: батч {batch_num}/{total_batches}...")
-            if not update_stocks(TARGET_WAREHOUSE_ID, batch):
-                # Если ошибка, делаем задержку перед следующим батчем
-                if i + batch_size < len(stocks_data):
-                    time.sleep(3)
-            
-            # Добавляем небольшую задержку между батчами для избежания 429 ошибок
-            if i + batch_size < len(stocks_data):
-                time.sleep(0.5)
+        send_batches("Остатки", list(stocks_by_sku.values()), lambda batch: update_stocks(warehouse_id, batch))
     else:
-        print(f"  ⚠ Нет данных для обновления остатков на складе {TARGET_WAREHOUSE_ID}")
+        print(f"  ⚠ Нет данных для обновления остатков на складе {warehouse_id}")
     
     # Обновляем цены
     if all_prices_data:
-        # Разбиваем на батчи по 100
-        batch_size = 100
-        total_batches = (len(all_prices_data) + batch_size - 1) // batch_size
-        for i in range(0, len(all_prices_data), batch_size):
-            batch = all_prices_data[i:i + batch_size]
-            batch_num = i//batch_size + 1
-            # Показываем прогресс каждые 10 батчей или последний батч
-            if batch_num % 10 == 0 or batch_num == total_batches:
-                print(f"  Цены: батч {batch_num}/{total_batches}...")
-            if not update_prices(batch):
-                # Если ошибка, делаем задержку перед следующим батчем
-                if i + batch_size < len(all_prices_data):
-                    time.sleep(3)
-            
-            # Добавляем небольшую задержку между батчами для избежания 429 ошибок
-            if i + batch_size < len(all_prices_data):
-                time.sleep(0.5)
+        # Повторы nmID между батчами тоже убираем заранее (действует последняя цена)
+        prices_by_nmid = {item["nmID"]: item for item in all_prices_data}
+        send_batches("Цены", list(prices_by_nmid.values()), update_prices)
     
     print("Обновление завершено!")
 